@@ -0,0 +1,751 @@
+"""
+Benchmark del bot segnalazioni.
+
+Uso:
+    python benchmark.py handler [--messaggi 5000] [--concorrenza 64]
+    python benchmark.py paginazione [--righe 200000]
+    python benchmark.py report [--righe 10000,100000,1000000]
+    python benchmark.py turni [--anni 2000-2100]
+    python benchmark.py ricerca [--righe 1000000]
+    python benchmark.py ingestione [--raffica 1000] [--chat 50]
+    python benchmark.py metriche [--messaggi 5000] [--giri 5]
+    python benchmark.py cache [--righe 200000] [--richieste 20000]
+    python benchmark.py trasferimento [--righe 1000000]
+    python benchmark.py statistiche [--righe 10000,100000,1000000]
+
+Ogni benchmark lavora su un database temporaneo, mai su segnalazioni.db.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, time as dt_time, timedelta, timezone
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+# Il bot legge DB_PATH all'import: va impostato prima. I worker del
+# process pool reimportano questo modulo ed ereditano la stessa cartella
+if "BENCH_CARTELLA" not in os.environ:
+    os.environ["BENCH_CARTELLA"] = tempfile.mkdtemp(prefix="bench_segnalazioni_")
+os.environ["DB_PATH"] = os.path.join(os.environ["BENCH_CARTELLA"], "bench.db")
+os.environ["CACHE_REPORT"] = os.path.join(os.environ["BENCH_CARTELLA"], "cache_report")
+
+import bot  # noqa: E402
+from database import apri_connessione, archivia, conta_segnalazioni, leggi_pagina  # noqa: E402
+from database import cerca_segnalazioni, espressione_fts  # noqa: E402
+from database import importa_righe, limiti_statistiche, ricostruisci_statistiche  # noqa: E402
+from metriche import registro, strumenta  # noqa: E402
+from report import MotoreReport  # noqa: E402
+from trasferimento import completa_indice, completa_statistiche, esporta, importa  # noqa: E402
+from turni import TURNI, calendario, turno_attuale  # noqa: E402
+from orario import da_epoch, offset_epoch, transizioni  # noqa: E402
+
+
+class MessaggioFinto:
+    # Risposte inviate da tutti i messaggi finti, per contare il traffico in uscita
+    risposte_totali = 0
+
+    def __init__(self, testo):
+        self.text = testo
+        self.risposte = 0
+        self.risposto = asyncio.Event()
+
+    async def reply_text(self, testo, **kwargs):
+        self.risposte += 1
+        MessaggioFinto.risposte_totali += 1
+        self.risposto.set()
+
+    async def reply_document(self, **kwargs):
+        self.risposte += 1
+        MessaggioFinto.risposte_totali += 1
+        self.risposto.set()
+
+
+class ChatFinta:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class UpdateFinto:
+    def __init__(self, testo, chat_id=0):
+        self.message = MessaggioFinto(testo)
+        self.effective_chat = ChatFinta(chat_id)
+        self.effective_user = None
+
+
+class QueryFinta:
+    def __init__(self, data):
+        self.data = data
+        self.risposto = asyncio.Event()
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, testo, **kwargs):
+        self.risposto.set()
+
+
+class UpdateCallbackFinto:
+    def __init__(self, data):
+        self.callback_query = QueryFinta(data)
+        self.message = None
+        self.effective_chat = ChatFinta(0)
+        self.effective_user = None
+
+
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    indice = min(len(ordinati) - 1, int(round(p / 100 * (len(ordinati) - 1))))
+    return ordinati[indice]
+
+
+def stampa_risultati(nome, latenze, durata):
+    print(
+        f"{nome:<28} {len(latenze) / durata:>10.0f} msg/s   "
+        f"p50 {statistics.median(latenze) * 1000:>8.2f} ms   "
+        f"p99 {percentile(latenze, 99) * 1000:>8.2f} ms"
+    )
+
+
+def ricrea_db():
+    if os.path.exists(os.environ["DB_PATH"]):
+        os.remove(os.environ["DB_PATH"])
+    for suffisso in ("-wal", "-shm"):
+        if os.path.exists(os.environ["DB_PATH"] + suffisso):
+            os.remove(os.environ["DB_PATH"] + suffisso)
+    bot.init_db()
+
+
+# Implementazione originale: una connessione per chiamata, query sul loop
+async def gestisci_messaggio_originale(update, context):
+    conn = sqlite3.connect(os.environ["DB_PATH"], check_same_thread=False)
+    conn.execute("PRAGMA synchronous=FULL")
+    c = conn.cursor()
+    c.execute(
+        "INSERT INTO segnalazioni (turno, segnalazione, data) VALUES (?, ?, ?)",
+        (bot.calcola_turno(), update.message.text, int(time.time())),
+    )
+    conn.commit()
+    conn.close()
+    await update.message.reply_text("ok")
+
+
+async def lista_originale(update, context):
+    conn = sqlite3.connect(os.environ["DB_PATH"], check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM segnalazioni ORDER BY data DESC, id DESC LIMIT 20")
+    c.fetchall()
+    conn.close()
+    await update.message.reply_text("ok")
+
+
+async def esegui_carico(handler_messaggi, handler_lista, messaggi, concorrenza, prima_chat=0):
+    """Invia gli update con la concorrenza indicata, uno su dieci è /lista."""
+    semaforo = asyncio.Semaphore(concorrenza)
+    latenze = []
+
+    async def invia(i):
+        async with semaforo:
+            handler = handler_lista if i % 10 == 0 else handler_messaggi
+            # Una chat per update: qui si misura il percorso singolo, non le raffiche
+            update = UpdateFinto(f"segnalazione di prova {i}", chat_id=prima_chat + i)
+            inizio = time.perf_counter()
+            await handler(update, None)
+            # L'ingestione risponde in un task separato: la latenza va fino alla conferma
+            await update.message.risposto.wait()
+            latenze.append(time.perf_counter() - inizio)
+
+    inizio = time.perf_counter()
+    await asyncio.gather(*(invia(i) for i in range(messaggi)))
+    return latenze, time.perf_counter() - inizio
+
+
+async def benchmark_handler(args):
+    ricrea_db()
+    latenze, durata = await esegui_carico(
+        gestisci_messaggio_originale, lista_originale, args.messaggi, args.concorrenza
+    )
+    stampa_risultati("prima (connect per update)", latenze, durata)
+
+    ricrea_db()
+    await bot.db.avvia()
+    try:
+        latenze, durata = await esegui_carico(
+            bot.gestisci_messaggio, bot.lista, args.messaggi, args.concorrenza
+        )
+    finally:
+        await bot.db.chiudi()
+    stampa_risultati("dopo (pool + group commit)", latenze, durata)
+
+
+async def benchmark_ingestione(args):
+    """Una chat inonda il bot mentre le altre scrivono normalmente."""
+    async def carico(handler):
+        MessaggioFinto.risposte_totali = 0
+        normali = [UpdateFinto(f"segnalazione normale {i}", chat_id=i + 1) for i in range(args.chat)]
+        raffica = [UpdateFinto(f"messaggio inoltrato {i}", chat_id=-1) for i in range(args.raffica)]
+        inizio = time.perf_counter()
+        # La raffica arriva tutta insieme, le chat normali a metà
+        meta = len(raffica) // 2
+        await asyncio.gather(*(handler(u, None) for u in raffica[:meta]))
+        partenza_normali = time.perf_counter()
+        await asyncio.gather(*(handler(u, None) for u in normali + raffica[meta:]))
+        await asyncio.gather(*(u.message.risposto.wait() for u in normali))
+        latenze = [time.perf_counter() - partenza_normali for _ in normali]
+        return latenze, time.perf_counter() - inizio
+
+    ricrea_db()
+    latenze, durata = await carico(gestisci_messaggio_originale)
+    print(f"prima: {MessaggioFinto.risposte_totali} risposte in uscita, "
+          f"conferma alle chat normali entro {max(latenze) * 1000:.1f} ms")
+
+    ricrea_db()
+    await bot.db.avvia()
+    try:
+        latenze, durata = await carico(bot.gestisci_messaggio)
+        await bot.ingestione.chiudi()
+    finally:
+        await bot.db.chiudi()
+    salvate = sqlite3.connect(os.environ["DB_PATH"]).execute(
+        "SELECT COUNT(*) FROM segnalazioni"
+    ).fetchone()[0]
+    print(f"dopo:  {MessaggioFinto.risposte_totali} risposte in uscita, "
+          f"conferma alle chat normali entro {max(latenze) * 1000:.1f} ms, "
+          f"{salvate} segnalazioni salvate")
+    print(f"metriche ingestione: {bot.ingestione.metriche()}")
+
+
+async def benchmark_metriche(args):
+    """Costo della strumentazione: stesso carico con le metriche spente e accese."""
+    gestisci = strumenta("gestisci_messaggio", bot.gestisci_messaggio)
+    lista = strumenta("lista", bot.lista)
+    ricrea_db()
+    await bot.db.avvia()
+    risultati = {False: [], True: []}
+    try:
+        # Un giro a vuoto per scaldare pool e cache, poi giri alternati
+        await esegui_carico(gestisci, lista, args.messaggi // 5, 64)
+        for giro in range(args.giri * 2):
+            registro.attivo = giro % 2 == 1
+            # Chat nuove a ogni giro: quelle già usate hanno il secchiello vuoto
+            latenze, durata = await esegui_carico(
+                gestisci, lista, args.messaggi, 64, prima_chat=(giro + 1) * args.messaggi
+            )
+            risultati[registro.attivo].append(len(latenze) / durata)
+    finally:
+        registro.attivo = True
+        await bot.db.chiudi()
+    spente = statistics.median(risultati[False])
+    accese = statistics.median(risultati[True])
+    print(f"metriche spente {spente:8.0f} msg/s   accese {accese:8.0f} msg/s   "
+          f"overhead {(spente - accese) / spente * 100:5.1f}%")
+    esportate = registro.esporta()
+    print(f"/metrics: {len(esportate.splitlines())} righe, {len(esportate)} byte")
+
+
+def testo_sintetico(i):
+    return f"segnalazione sintetica numero {i}"
+
+
+def popola_db(righe, lotto=50000, testo=testo_sintetico):
+    """Riempie il database con segnalazioni sintetiche, una ogni 30 secondi."""
+    conn = apri_connessione(os.environ["DB_PATH"])
+    conn.execute("PRAGMA synchronous=OFF")
+    base = 1700000000
+    for inizio in range(0, righe, lotto):
+        conn.executemany(
+            "INSERT INTO segnalazioni (turno, segnalazione, data) VALUES (?, ?, ?)",
+            (
+                ("ABCD"[(i // 24) % 4], testo(i), base + i * 30)
+                for i in range(inizio, min(righe, inizio + lotto))
+            ),
+        )
+        conn.commit()
+    return conn
+
+
+def cronometra(funzione, ripetizioni=20):
+    inizio = time.perf_counter()
+    for _ in range(ripetizioni):
+        funzione()
+    return (time.perf_counter() - inizio) / ripetizioni * 1000
+
+
+async def benchmark_paginazione(args):
+    ricrea_db()
+    conn = popola_db(args.righe)
+    limite = bot.SEGNALAZIONI_PER_PAGINA
+    pagina_profonda = args.righe // limite // 2
+
+    # Cursore della pagina profonda, ricavato una volta sola
+    cursore = tuple(conn.execute(
+        "SELECT data, id FROM segnalazioni ORDER BY data DESC, id DESC LIMIT 1 OFFSET ?",
+        (pagina_profonda * limite - 1,),
+    ).fetchone())
+
+    def offset(pagina):
+        return lambda: conn.execute(
+            "SELECT * FROM segnalazioni ORDER BY data DESC, id DESC LIMIT ? OFFSET ?",
+            (limite, pagina * limite),
+        ).fetchall()
+
+    print(f"{args.righe} righe, pagina profonda n. {pagina_profonda + 1}")
+    print(f"OFFSET   pagina 1: {cronometra(offset(0)):8.3f} ms   "
+          f"pagina profonda: {cronometra(offset(pagina_profonda)):8.3f} ms")
+    print(f"cursore  pagina 1: {cronometra(lambda: leggi_pagina(conn, None)):8.3f} ms   "
+          f"pagina profonda: {cronometra(lambda: leggi_pagina(conn, cursore)):8.3f} ms")
+    conn.close()
+
+
+def rss_massimo_mb():
+    # ru_maxrss è in KiB su Linux; i figli contano solo dopo la loro terminazione
+    proprio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    figli = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return proprio / 1024, figli / 1024
+
+
+async def genera_report(processi):
+    motore = MotoreReport(bot.db, processi=processi)
+    try:
+        inizio = time.perf_counter()
+        async with motore.report() as (path, totale):
+            dimensione = os.path.getsize(path)
+        return time.perf_counter() - inizio, totale, dimensione
+    finally:
+        motore.chiudi()
+
+
+async def benchmark_report(args):
+    for righe in (int(n) for n in args.righe.split(",")):
+        ricrea_db()
+        shutil.rmtree(os.environ["CACHE_REPORT"], ignore_errors=True)
+        popola_db(righe).close()
+        await bot.db.avvia()
+        try:
+            freddo, totale, dimensione = await genera_report(args.processi)
+            caldo, _, _ = await genera_report(args.processi)
+        finally:
+            await bot.db.chiudi()
+        proprio, figli = rss_massimo_mb()
+        print(
+            f"{totale:>8} righe   PDF {dimensione / 2**20:7.1f} MB   "
+            f"cache vuota {freddo:7.2f} s   cache piena {caldo:7.2f} s   "
+            f"RSS max bot {proprio:6.0f} MB, worker {figli:6.0f} MB"
+        )
+
+
+# Implementazione originale di fuso e turno, ricalcolati a ogni chiamata
+def get_tz_italia_originale():
+    now = datetime.now()
+
+    def is_dst(dt):
+        dst_start = datetime(dt.year, 3, 31)
+        while dst_start.weekday() != 6:
+            dst_start -= timedelta(days=1)
+        dst_end = datetime(dt.year, 10, 31)
+        while dst_end.weekday() != 6:
+            dst_end -= timedelta(days=1)
+        return dst_start <= dt.replace(tzinfo=None) <= dst_end
+
+    return timezone(timedelta(hours=2 if is_dst(now) else 1))
+
+
+def calcola_turno_originale():
+    data_riferimento = datetime(2024, 10, 18, tzinfo=get_tz_italia_originale())
+    oggi = datetime.now(get_tz_italia_originale())
+    giorni_passati = (oggi - data_riferimento).days
+    if dt_time(8, 0) <= oggi.time() < dt_time(20, 0):
+        return TURNI[(giorni_passati + 1) % len(TURNI)]
+    return TURNI[giorni_passati % len(TURNI)]
+
+
+def verifica_calendario(primo, ultimo):
+    """Confronta offset e finestre con zoneinfo, ora per ora e attorno a ogni cambio."""
+    from zoneinfo import ZoneInfo
+    roma = ZoneInfo("Europe/Rome")
+    inizio = int(datetime(primo, 1, 1, tzinfo=timezone.utc).timestamp())
+    fine = int(datetime(ultimo + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+
+    istanti = list(range(inizio, fine, 3600))
+    for anno in range(primo, ultimo + 1):
+        for cambio in transizioni(anno):
+            istanti.extend(cambio + delta for delta in (-3601, -3600, -1, 0, 1, 3599, 3600))
+    errori = 0
+    for epoch in istanti:
+        atteso = datetime.fromtimestamp(epoch, roma).utcoffset().total_seconds() / 3600
+        if offset_epoch(epoch) != atteso or da_epoch(epoch).utcoffset().total_seconds() / 3600 != atteso:
+            errori += 1
+
+    finestre = calendario.finestre_tra(inizio, fine)
+    for precedente, finestra in zip(finestre, finestre[1:]):
+        locale = datetime.fromtimestamp(finestra.inizio, roma)
+        # Finestre contigue, cambi alle 08:00 e 20:00 locali, alternanza giorno/notte
+        if (precedente.fine != finestra.inizio
+                or (locale.hour, locale.minute) != ((20, 0) if finestra.notturno else (8, 0))
+                or precedente.notturno == finestra.notturno):
+            errori += 1
+        # Chi fa il diurno fa il notturno del giorno dopo
+        if not precedente.notturno:
+            successivo = calendario.finestra(precedente.fine + 25 * 3600)
+            if not successivo.notturno or successivo.turno != precedente.turno:
+                errori += 1
+        durata = finestra.fine - finestra.inizio
+        if durata != 12 * 3600 and not (finestra.notturno and durata in (11 * 3600, 13 * 3600)):
+            errori += 1
+        if not (finestra.inizio <= finestra.inizio + durata // 2 < finestra.fine) or \
+                calendario.finestra(finestra.inizio + durata // 2) != finestra:
+            errori += 1
+    return len(istanti), len(finestre), errori
+
+
+async def benchmark_turni(args):
+    primo, ultimo = (int(a) for a in args.anni.split("-"))
+    istanti, finestre, errori = verifica_calendario(primo, ultimo)
+    print(f"verifica {primo}-{ultimo}: {istanti} istanti, {finestre} finestre, {errori} errori")
+
+    # Il 18/10/2024 alle 12:00 il diurno è della squadra B
+    riferimento = int(datetime(2024, 10, 18, 10, tzinfo=timezone.utc).timestamp())
+    print(f"turno 18/10/2024 12:00: {turno_attuale(riferimento)[0]}")
+
+    ripetizioni = 100000
+    adesso = time.time()
+    inizio = time.perf_counter()
+    for _ in range(ripetizioni):
+        calcola_turno_originale()
+        get_tz_italia_originale()
+    prima = (time.perf_counter() - inizio) / ripetizioni * 1e6
+    inizio = time.perf_counter()
+    for i in range(ripetizioni):
+        turno_attuale(adesso + i)
+    dopo = (time.perf_counter() - inizio) / ripetizioni * 1e6
+    print(f"turno + fuso per messaggio: prima {prima:.2f} us, dopo {dopo:.2f} us")
+
+
+# Vocabolario sintetico: poche parole frequenti e molte rare, come nei
+# messaggi reali
+_SILLABE = ["ca", "ri", "pon", "to", "ve", "la", "mer", "sa", "di", "gno", "ter", "bo"]
+_COMUNI = ["guasto", "pompa", "allarme", "porta", "luce", "cancello", "perdita", "rumore"]
+
+
+def testo_casuale(i):
+    casuale = random.Random(i)
+    parole = [casuale.choice(_COMUNI)]
+    for _ in range(casuale.randint(4, 12)):
+        parole.append("".join(casuale.choice(_SILLABE) for _ in range(casuale.randint(2, 4))))
+    if i % 100000 == 7:
+        parole.append("idrante")
+    return " ".join(parole)
+
+
+async def benchmark_ricerca(args):
+    ricrea_db()
+    inizio = time.perf_counter()
+    conn = popola_db(args.righe, testo=testo_casuale)
+    print(f"{args.righe} righe caricate e indicizzate in {time.perf_counter() - inizio:.1f} s")
+
+    ricerche = [["guasto"], ["pompa", "cari"], ["mersa", "tobo"], ["pon"], ["idrante"], ["idr", "guasto"]]
+    for termini in ricerche:
+        espressione = espressione_fts(termini)
+        fts = cronometra(lambda: cerca_segnalazioni(conn, espressione), 5)
+        # Per ordinare per pertinenza LIKE deve trovare tutte le corrispondenze
+        condizioni = " AND ".join("segnalazione LIKE ?" for _ in termini)
+        like = cronometra(lambda: conn.execute(
+            f"SELECT id, segnalazione FROM segnalazioni WHERE {condizioni}",
+            [f"%{t}%" for t in termini],
+        ).fetchall(), 2)
+        trovate = conn.execute(
+            "SELECT COUNT(*) FROM segnalazioni_fts WHERE segnalazioni_fts MATCH ?", (espressione,)
+        ).fetchone()[0]
+        print(f"{' '.join(termini):<14} {trovate:>8} risultati   FTS5 {fts:9.2f} ms   LIKE {like:9.2f} ms")
+    conn.close()
+
+
+async def carico_letture(richieste, cursori, prima_chat):
+    """
+    Carico misto a prevalenza di letture: /lista, pagine successive e /ora,
+    con una segnalazione nuova ogni dieci richieste.
+    """
+    semaforo = asyncio.Semaphore(64)
+    latenze = {"lista": [], "pagina": [], "ora": []}
+    casuale = random.Random(1)
+    piano = [casuale.random() for _ in range(richieste)]
+
+    async def invia(i):
+        async with semaforo:
+            if piano[i] < 0.1:
+                update = UpdateFinto(f"segnalazione nuova {i}", chat_id=prima_chat + i)
+                await bot.gestisci_messaggio(update, None)
+                return
+            if piano[i] < 0.6:
+                tipo, update, handler = "lista", UpdateFinto("/lista"), bot.lista
+            elif piano[i] < 0.9:
+                cursore = cursori[int(piano[i] * 1000) % len(cursori)]
+                tipo, update, handler = "pagina", UpdateCallbackFinto(f"lista:succ:{cursore[0]}:{cursore[1]}"), bot.lista_pagina
+            else:
+                tipo, update, handler = "ora", UpdateFinto("/ora"), bot.ora_bot
+            inizio = time.perf_counter()
+            await handler(update, None)
+            latenze[tipo].append(time.perf_counter() - inizio)
+
+    inizio = time.perf_counter()
+    await asyncio.gather(*(invia(i) for i in range(richieste)))
+    durata = time.perf_counter() - inizio
+    await bot.ingestione.chiudi()
+    return latenze, durata
+
+
+async def benchmark_cache(args):
+    ricrea_db()
+    conn = popola_db(args.righe)
+    # Cursori delle prime cinquanta pagine, come quelli dei pulsanti di /lista
+    cursori, cursore = [], None
+    for _ in range(50):
+        righe, _, _ = leggi_pagina(conn, cursore, "succ", bot.SEGNALAZIONI_PER_PAGINA)
+        cursore = (righe[-1]["data"], righe[-1]["id"])
+        cursori.append(cursore)
+    await bot.db.avvia()
+    capacita = bot.cache_liste.capacita, bot.cache_ora.capacita
+    try:
+        for giro, attiva in enumerate((False, True)):
+            bot.cache_liste.svuota()
+            bot.cache_ora.svuota()
+            # Capacità zero: ogni lettura è un miss, come senza cache
+            bot.cache_liste.capacita, bot.cache_ora.capacita = capacita if attiva else (0, 0)
+            latenze, durata = await carico_letture(
+                args.richieste, cursori, prima_chat=(giro + 1) * args.richieste
+            )
+            letture = sum(len(v) for v in latenze.values())
+            print(f"cache {'accesa' if attiva else 'spenta'}: {letture / durata:8.0f} letture/s")
+            for tipo, valori in latenze.items():
+                stampa_risultati(f"  {tipo}", valori, durata)
+
+        # Le voci sopravvissute alle insert devono coincidere con il database
+        errate = 0
+        totale = bot.cache_liste.leggi("totale")
+        for chiave, pagina in bot.cache_liste.voci():
+            if chiave == "totale":
+                continue
+            righe, piu_recenti, piu_vecchie, totale_db = bot.leggi_pagina_lista(conn, *chiave)
+            attese = ([dict(r) for r in righe], piu_recenti, piu_vecchie)
+            trovate = ([dict(r) for r in pagina[0]], pagina[1], pagina[2])
+            errate += attese != trovate
+        print(f"voci in cache {len(bot.cache_liste)}, diverse dal database {errate}, "
+              f"totale {'corretto' if totale == totale_db else 'ERRATO'}, espulse {bot.cache_liste.espulse}")
+        for riga in registro.esporta().splitlines():
+            if riga.startswith("vigilbot_cache"):
+                print(riga)
+    finally:
+        bot.cache_liste.capacita, bot.cache_ora.capacita = capacita
+        await bot.db.chiudi()
+        conn.close()
+
+
+async def benchmark_trasferimento(args):
+    """Importazione ed esportazione da file, archiviazione e /lista sugli archivi."""
+    cartella = os.environ["BENCH_CARTELLA"]
+    base = int(time.time()) - args.righe * 30
+    for formato in ("csv", "jsonl"):
+        ricrea_db()
+        sorgente = os.path.join(cartella, f"sorgente.{formato}")
+        with open(sorgente, "w", newline="", encoding="utf-8") as f:
+            if formato == "csv":
+                scrittore = csv.writer(f)
+                scrittore.writerow(["turno", "segnalazione", "data"])
+                scrittore.writerows(
+                    ("ABCD"[(i // 24) % 4], testo_casuale(i), base + i * 30) for i in range(args.righe)
+                )
+            else:
+                f.writelines(json.dumps({
+                    "turno": "ABCD"[(i // 24) % 4], "segnalazione": testo_casuale(i), "data": base + i * 30,
+                }, ensure_ascii=False) + "\n" for i in range(args.righe))
+        conn = apri_connessione(os.environ["DB_PATH"])
+        inizio = time.perf_counter()
+        with open(sorgente, newline="", encoding="utf-8") as f:
+            importate = importa(conn, f, formato)
+        durata = time.perf_counter() - inizio
+        esito = "ok" if importate / durata >= 100000 else "SOTTO L'OBIETTIVO di 100000/s"
+        print(f"importa {formato:<6} {importate:>9} righe {durata:6.2f} s {importate / durata:>9.0f} righe/s  {esito}")
+        inizio = time.perf_counter()
+        indicizzate = completa_indice(conn)
+        print(f"indice full-text {indicizzate:>9} righe {time.perf_counter() - inizio:6.2f} s")
+        inizio = time.perf_counter()
+        with open(os.path.join(cartella, f"esportate.{formato}"), "w", newline="", encoding="utf-8") as f:
+            esportate = esporta(conn, f, formato)
+        durata = time.perf_counter() - inizio
+        print(f"esporta {formato:<6} {esportate:>9} righe {durata:6.2f} s {esportate / durata:>9.0f} righe/s  "
+              f"RSS massimo {rss_massimo_mb()[0]:.0f} MB")
+
+    # Archiviazione: nel database principale restano il mese in corso e il precedente
+    limite = leggi_pagina(conn, None, "succ", bot.SEGNALAZIONI_PER_PAGINA)[0]
+    profonda = leggi_pagina(conn, (base + args.righe // 2 * 30, 0), "succ", bot.SEGNALAZIONI_PER_PAGINA)[0]
+    prima = cronometra(lambda: leggi_pagina(conn, (base + args.righe // 2 * 30, 0), "succ", 20), 200)
+    inizio = time.perf_counter()
+    mesi = archivia(conn, 1)
+    durata = time.perf_counter() - inizio
+    principale = conn.execute("SELECT COUNT(*) FROM main.segnalazioni").fetchone()[0]
+    print(f"archivia {len(mesi)} mesi, {sum(m[2] for m in mesi)} righe in {durata:.2f} s; "
+          f"nel principale ne restano {principale} su {conta_segnalazioni(conn)}")
+    uguali = (
+        leggi_pagina(conn, None, "succ", bot.SEGNALAZIONI_PER_PAGINA)[0] == limite
+        and leggi_pagina(conn, (base + args.righe // 2 * 30, 0), "succ", bot.SEGNALAZIONI_PER_PAGINA)[0] == profonda
+    )
+    dopo = cronometra(lambda: leggi_pagina(conn, (base + args.righe // 2 * 30, 0), "succ", 20), 200)
+    print(f"/lista su una pagina archiviata: {prima:.3f} ms prima, {dopo:.3f} ms dopo, "
+          f"pagine {'identiche' if uguali else 'DIVERSE'}")
+    conn.close()
+
+
+def statistiche_attese(conn, adesso):
+    """Gli aggregati ricalcolati riga per riga con zoneinfo, indipendenti da orario.py."""
+    prima_ora, primo_giorno = limiti_statistiche(adesso)
+    roma = ZoneInfo("Europe/Rome")
+    attese = {"ore": Counter(), "giorni": Counter(), "mesi": Counter(), "fasce": Counter()}
+    for turno, data in conn.execute("SELECT turno, data FROM segnalazioni"):
+        locale = datetime.fromtimestamp(data, roma)
+        giorno = locale.year * 10000 + locale.month * 100 + locale.day
+        if data - data % 3600 >= prima_ora:
+            attese["ore"][data - data % 3600, turno] += 1
+        if giorno >= primo_giorno:
+            attese["giorni"][giorno, turno] += 1
+        attese["mesi"][locale.year * 100 + locale.month, turno] += 1
+        attese["fasce"][locale.hour, turno] += 1
+    return attese
+
+
+def statistiche_salvate(conn, adesso):
+    prima_ora, primo_giorno = limiti_statistiche(adesso)
+    # Un cambio d'ora durante il giro può lasciare un'ora in più, non ancora scartata
+    return {
+        "ore": Counter({(o, t): n for o, t, n in conn.execute(
+            "SELECT ora, turno, conteggio FROM statistiche_ore WHERE ora >= ?", (prima_ora,))}),
+        "giorni": Counter({(g, t): n for g, t, n in conn.execute(
+            "SELECT giorno, turno, conteggio FROM statistiche_giorni WHERE giorno >= ?", (primo_giorno,))}),
+        "mesi": Counter({(m, t): n for m, t, n in conn.execute(
+            "SELECT mese, turno, conteggio FROM statistiche_mesi")}),
+        "fasce": Counter({(f, t): n for f, t, n in conn.execute(
+            "SELECT fascia, turno, conteggio FROM statistiche_fasce")}),
+    }
+
+
+async def benchmark_statistiche(args):
+    """/statistiche dagli aggregati al crescere delle righe, verifica e ricostruzione."""
+    contesto = SimpleNamespace(args=["14"])
+    for righe in (int(n) for n in args.righe.split(",")):
+        ricrea_db()
+        conn = apri_connessione(os.environ["DB_PATH"])
+        # Sempre 500 giorni di storia, oltre la durata degli aggregati giornalieri
+        adesso = int(time.time())
+        passo = 500 * 86400 / righe
+        casuale = random.Random(righe)
+        dal_writer = min(2000, righe // 10)
+        for inizio in range(0, righe - dal_writer, 50000):
+            importa_righe(conn, [
+                (casuale.choice(TURNI), testo_sintetico(i), int(adesso - (righe - i) * passo))
+                for i in range(inizio, min(righe - dal_writer, inizio + 50000))
+            ])
+        # Le ultime arrivano dal writer, come dai messaggi del bot
+        await bot.db.avvia()
+        try:
+            await asyncio.gather(*(
+                bot.db.inserisci_segnalazione(casuale.choice(TURNI), testo_sintetico(i), int(adesso - (righe - i) * passo))
+                for i in range(righe - dal_writer, righe)
+            ))
+            attese = statistiche_attese(conn, adesso)
+            incrementali = statistiche_salvate(conn, adesso) == attese
+
+            latenze = []
+            for _ in range(200):
+                inizio = time.perf_counter()
+                await bot.statistiche(UpdateFinto("/statistiche 14"), contesto)
+                latenze.append(time.perf_counter() - inizio)
+        finally:
+            await bot.db.chiudi()
+        # Per confronto: gli stessi totali per turno e per fascia con una scansione
+        scansione = cronometra(lambda: (
+            conn.execute("SELECT turno, COUNT(*) FROM segnalazioni GROUP BY turno").fetchall(),
+            conn.execute("SELECT data / 3600 % 24, turno, COUNT(*) FROM segnalazioni GROUP BY 1, 2").fetchall(),
+        ), 5)
+
+        inizio = time.perf_counter()
+        ricostruisci_statistiche(conn)
+        completa_statistiche(conn)
+        durata = time.perf_counter() - inizio
+        ricostruite = statistiche_salvate(conn, adesso) == attese
+        print(
+            f"{righe:>8} righe  /statistiche p50 {statistics.median(latenze) * 1000:6.2f} ms "
+            f"p99 {percentile(latenze, 99) * 1000:6.2f} ms   scansione GROUP BY {scansione:8.2f} ms   "
+            f"incrementali {'corretti' if incrementali else 'ERRATI'}   "
+            f"ricostruzione {durata:5.2f} s ({righe / durata:.0f} righe/s) "
+            f"{'corretta' if ricostruite else 'ERRATA'}"
+        )
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sotto = parser.add_subparsers(dest="comando", required=True)
+
+    p = sotto.add_parser("handler", help="throughput e latenza degli handler")
+    p.add_argument("--messaggi", type=int, default=5000)
+    p.add_argument("--concorrenza", type=int, default=64)
+    p.set_defaults(funzione=benchmark_handler)
+
+    p = sotto.add_parser("paginazione", help="costo di /lista per pagina, cursore contro OFFSET")
+    p.add_argument("--righe", type=int, default=200000)
+    p.set_defaults(funzione=benchmark_paginazione)
+
+    p = sotto.add_parser("report", help="tempo di rendering e RSS massimo del report PDF")
+    p.add_argument("--righe", default="10000,100000,1000000")
+    p.add_argument("--processi", type=int, default=None)
+    p.set_defaults(funzione=benchmark_report)
+
+    p = sotto.add_parser("turni", help="verifica del calendario sui cambi d'ora e microbenchmark")
+    p.add_argument("--anni", default="2000-2100")
+    p.set_defaults(funzione=benchmark_turni)
+
+    p = sotto.add_parser("ricerca", help="/cerca con FTS5 contro una scansione LIKE")
+    p.add_argument("--righe", type=int, default=1000000)
+    p.set_defaults(funzione=benchmark_ricerca)
+
+    p = sotto.add_parser("ingestione", help="raffica da una chat: raggruppamento e scarto")
+    p.add_argument("--raffica", type=int, default=1000)
+    p.add_argument("--chat", type=int, default=50)
+    p.set_defaults(funzione=benchmark_ingestione)
+
+    p = sotto.add_parser("metriche", help="overhead della strumentazione sotto carico")
+    p.add_argument("--messaggi", type=int, default=5000)
+    p.add_argument("--giri", type=int, default=5)
+    p.set_defaults(funzione=benchmark_metriche)
+
+    p = sotto.add_parser("cache", help="/lista e /ora con e senza cache delle risposte")
+    p.add_argument("--righe", type=int, default=200000)
+    p.add_argument("--richieste", type=int, default=20000)
+    p.set_defaults(funzione=benchmark_cache)
+
+    p = sotto.add_parser("trasferimento", help="importazione, esportazione e archivi")
+    p.add_argument("--righe", type=int, default=1000000)
+    p.set_defaults(funzione=benchmark_trasferimento)
+
+    p = sotto.add_parser("statistiche", help="/statistiche dagli aggregati, verifica e ricostruzione")
+    p.add_argument("--righe", default="10000,100000,1000000")
+    p.set_defaults(funzione=benchmark_statistiche)
+
+    args = parser.parse_args()
+    try:
+        asyncio.run(args.funzione(args))
+    finally:
+        shutil.rmtree(os.environ["BENCH_CARTELLA"], ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,79 +1,96 @@
+import argparse
+import asyncio
 import os
-import sqlite3
-from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-from fpdf import FPDF
-from datetime import datetime, time, timezone, timedelta
+import sys
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
+from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+import time
+from datetime import timedelta
 from dotenv import load_dotenv
+from orario import da_epoch, ora_italia, prossimo_cambio_ora
+from turni import TURNI, calendario, turno_attuale
+from database import (
+    Database, apri_connessione, migra, conta_segnalazioni, leggi_pagina,
+    cerca_segnalazioni, espressione_fts, ricerca_incompleta, prossimo_id, CANDIDATI_RICERCA,
+    modifiche_esterne, archivia, aggiorna_archivi, leggi_statistiche, chiave_giorno, ricostruisci_statistiche
+)
+from cache import CacheLRU
+from ingestione import Ingestione, metriche_prometheus
+from metriche import registro, strumenta_applicazione
+from profilatore import Profilatore
+from trasferimento import importa, esporta, completa_indice, completa_statistiche, formato_da_file
+from webhook import esegui_webhook
+from report import MotoreReport, leggi_filtri, separa_filtri, descrivi_filtri, limiti_giorno
 
 # Carica le variabili di ambiente
 load_dotenv()
 
-def get_tz_italia():
-    """
-    Restituisce il fuso orario italiano corretto basandosi sulla data
-    per gestire automaticamente ora legale/solare
-    """
-    now = datetime.now()
-    
-    def is_dst(dt):
-        # Ultima domenica di marzo
-        dst_start = datetime(dt.year, 3, 31)
-        while dst_start.weekday() != 6:  # 6 = domenica
-            dst_start -= timedelta(days=1)
-        
-        # Ultima domenica di ottobre
-        dst_end = datetime(dt.year, 10, 31)
-        while dst_end.weekday() != 6:  # 6 = domenica
-            dst_end -= timedelta(days=1)
-        
-        return dst_start <= dt.replace(tzinfo=None) <= dst_end
-    
-    return timezone(timedelta(hours=2 if is_dst(now) else 1))
-
-# Connessione al database SQLite
-def get_db_connection():
-    conn = sqlite3.connect('segnalazioni.db', check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Sottosistema di persistenza condiviso da tutti gli handler
+db = Database()
+motore_report = MotoreReport(db)
 
-# Crea la tabella se non esiste
+# Crea la tabella se non esiste e applica le migrazioni dello schema
 def init_db():
+    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS segnalazioni
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                     turno TEXT, 
-                     segnalazione TEXT,
-                     data TEXT)''')
-        conn.commit()
+        conn = apri_connessione(db.path)
+        migra(conn)
+        aggiorna_archivi(conn)
     except Exception as e:
         print(f"Errore nell'inizializzazione del database: {e}")
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
 
-# Funzione per calcolare il turno corrente
-def calcola_turno():
-    # Aggiungi il fuso orario alla data di riferimento
-    data_riferimento = datetime(2024, 10, 18, tzinfo=get_tz_italia())
-    oggi = datetime.now(get_tz_italia())
-    turni = ['A', 'B', 'C', 'D']
-    giorni_passati = (oggi - data_riferimento).days
-    ora_attuale = oggi.time()
-    orario_diurno_inizio = time(8, 0)
-    orario_notturno_inizio = time(20, 0)
-    
-    if orario_diurno_inizio <= ora_attuale < orario_notturno_inizio:
-        indice_turno = (giorni_passati + 1) % len(turni)
-    else:
-        indice_turno = giorni_passati % len(turni)
-    
-    return turni[indice_turno]
+# Avvio e arresto del database legati al ciclo di vita dell'applicazione.
+# L'arresto gira dopo stop() e prima di shutdown(): le segnalazioni ancora
+# in coda si salvano e il bot può ancora confermarle
+async def avvia_db(application):
+    global sorveglianza
+    await db.avvia()
+    sorveglianza = asyncio.create_task(sorveglia_database())
+
+async def chiudi_db(application):
+    if sorveglianza is not None:
+        sorveglianza.cancel()
+    await ingestione.chiudi()
+    print(f"Ingestione: {ingestione.metriche()}")
+    motore_report.chiudi()
+    await db.chiudi()
+
+sorveglianza = None
+
+# Le segnalazioni fuori dall'indice di ricerca vengono indicizzate in
+# background, senza ritardare l'avvio. Importazioni e archiviazioni fatte
+# da riga di comando, in un altro processo, si notano dal contatore
+# modifiche_esterne: la cache di /lista si svuota e l'indice si completa
+async def sorveglia_database(intervallo=5):
+    ultima = None
+    while True:
+        try:
+            modifiche = await db.leggi(modifiche_esterne)
+            if modifiche != ultima:
+                if ultima is not None:
+                    cache_liste.svuota()
+                ultima = modifiche
+                await db.indicizza_ricerca()
+                await db.completa_statistiche()
+        except Exception as e:
+            print(f"Errore nella sorveglianza del database: {e}")
+        await asyncio.sleep(intervallo)
+
+# Le date sono salvate come epoch UTC: qui si convertono in ora italiana
+def formatta_data(epoch, formato="%Y-%m-%d %H:%M:%S"):
+    return da_epoch(epoch).strftime(formato)
+
+# Funzione per calcolare il turno corrente, dal calendario precalcolato
+def calcola_turno(epoch=None):
+    return turno_attuale(epoch)[0]
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [['/start', '/lista', '/genera_PDF'],
-                ['/ora', '/aiuto']]
+                ['/ora', '/turni', '/aiuto']]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text(
         "Benvenuto nel Bot di gestione segnalazioni!\n\n"
@@ -87,9 +104,13 @@ async def aiuto(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📋 *Guida del Bot*\n\n"
         "*Comandi disponibili:*\n"
         "• /start - Avvia il bot e mostra il menu principale\n"
-        "• /lista - Visualizza le ultime 20 segnalazioni\n"
+        "• /lista - Visualizza le segnalazioni, 20 per pagina\n"
         "• /genera_PDF - Crea un PDF con tutte le segnalazioni\n"
+        "  Filtri opzionali: /genera_PDF 01/10/2024 15/10/2024 B\n"
+        "• /cerca - Cerca tra le segnalazioni, es. /cerca pompa 01/10/2024 B\n"
         "• /ora - Mostra l'ora attuale del bot e il turno\n"
+        "• /turni - Mostra la rotazione dei prossimi turni\n"
+        "• /statistiche - Conteggi per turno e per giorno, es. /statistiche 14\n"
         "• /aiuto - Mostra questo messaggio di aiuto\n\n"
         "*Come funziona:*\n"
         "- Ogni messaggio che invii viene salvato come segnalazione\n"
@@ -100,108 +121,456 @@ async def aiuto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(guida, parse_mode='Markdown')
 
 async def gestisci_messaggio(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    testo_segnalazione = update.message.text
-    
+    # Il messaggio passa dallo stadio di ingestione, che lo salva subito
+    # o lo raggruppa con il resto della raffica della stessa chat
+    if update.message is None:
+        return
+    await ingestione.accoda(update.effective_chat.id, update.message)
+
+async def salva_segnalazioni(lotto):
+    # Un elemento senza testo non deve far perdere il resto della raffica
+    lotto = [(m, arrivo) for m, arrivo in lotto if m is not None and m.text]
+    if not lotto:
+        return
+    messaggio = lotto[-1][0]
     try:
-        turno = calcola_turno()
-        data = datetime.now(get_tz_italia()).strftime("%Y-%m-%d %H:%M:%S")
+        epoche = [int(arrivo) for _, arrivo in lotto]
+        turni_lotto = [calcola_turno(epoch) for epoch in epoche]
         
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO segnalazioni (turno, segnalazione, data) VALUES (?, ?, ?)",
-                 (turno, testo_segnalazione, data))
-        conn.commit()
-        conn.close()
+        # Risponde solo quando il gruppo di insert è stato committato
+        await asyncio.gather(*(
+            db.inserisci_segnalazione(turno, m.text, epoch)
+            for (m, _), epoch, turno in zip(lotto, epoche, turni_lotto)
+        ))
         
-        await update.message.reply_text(
-            f"✅ Segnalazione registrata!\n"
-            f"📝 Turno: {turno}\n"
-            f"🕒 Data: {data}"
-        )
+        if len(lotto) == 1:
+            await messaggio.reply_text(
+                f"✅ Segnalazione registrata!\n"
+                f"📝 Turno: {turni_lotto[0]}\n"
+                f"🕒 Data: {formatta_data(epoche[0])}"
+            )
+        else:
+            await messaggio.reply_text(
+                f"✅ {len(lotto)} segnalazioni registrate!\n"
+                f"📝 Turno: {', '.join(sorted(set(turni_lotto)))}\n"
+                f"🕒 Dalle {formatta_data(epoche[0])} alle {formatta_data(epoche[-1])}"
+            )
     except Exception as e:
-        await update.message.reply_text(f"❌ Errore: {str(e)}")
+        await messaggio.reply_text(f"❌ Errore: {str(e)}")
+
+async def avvisa_scarto(messaggio):
+    await messaggio.reply_text(
+        "⚠️ Troppe segnalazioni in arrivo: alcuni messaggi non sono stati "
+        "registrati. Riprova tra qualche secondo."
+    )
+
+ingestione = Ingestione(salva_segnalazioni, avvisa_scarto)
+registro.raccolta(lambda: metriche_prometheus(ingestione))
+
+SEGNALAZIONI_PER_PAGINA = 20
+
+def leggi_pagina_lista(conn, cursore, direzione):
+    righe, piu_recenti, piu_vecchie = leggi_pagina(
+        conn, cursore, direzione, SEGNALAZIONI_PER_PAGINA
+    )
+    return righe, piu_recenti, piu_vecchie, conta_segnalazioni(conn)
+
+# Testo e tastiera di una pagina di risultati; i pulsanti portano il cursore
+# della riga di confine, così ogni pagina costa come la prima
+def componi_pagina(intestazione, righe, indietro, avanti, callback, colonna_cursore, etichette):
+    risposta = intestazione + "\n\n" + "\n\n".join(
+        f"🔸 *Turno {row['turno']}*\n"
+        f"📝 {escape_markdown(row['segnalazione'])}\n"
+        f"🕒 {formatta_data(row['data'])}"
+        for row in righe
+    )
+    pulsanti = []
+    if indietro:
+        prima = righe[0]
+        pulsanti.append(InlineKeyboardButton(
+            etichette[0], callback_data=f"{callback}:prec:{prima[colonna_cursore]!r}:{prima['id']}"))
+    if avanti:
+        ultima = righe[-1]
+        pulsanti.append(InlineKeyboardButton(
+            etichette[1], callback_data=f"{callback}:succ:{ultima[colonna_cursore]!r}:{ultima['id']}"))
+    tastiera = InlineKeyboardMarkup([pulsanti]) if pulsanti else None
+    return risposta, tastiera
+
+# Il corpo della pagina non dipende dal totale, che cambia a ogni insert:
+# l'intestazione si compone a parte
+def componi_pagina_lista(righe, piu_recenti, piu_vecchie):
+    return componi_pagina(
+        "", righe, piu_recenti, piu_vecchie,
+        "lista", "data", ("⬅️ Più recenti", "Più vecchie ➡️")
+    )
+
+def intestazione_lista(totale):
+    return f"*📋 Segnalazioni (totale: {totale}):*"
+
+# Pagine di /lista già composte, per cursore e direzione, più il totale
+cache_liste = CacheLRU("lista", 256)
+
+async def pagina_lista(cursore, direzione):
+    """Restituisce ((righe, più_recenti, più_vecchie, corpo, tastiera), totale)."""
+    chiave = (cursore, direzione)
+    pagina = cache_liste.leggi(chiave)
+    totale = cache_liste.leggi("totale")
+    if pagina is None or totale is None:
+        versione = cache_liste.versione
+        righe, piu_recenti, piu_vecchie, totale = await db.leggi(
+            leggi_pagina_lista, cursore, direzione
+        )
+        corpo, tastiera = componi_pagina_lista(righe, piu_recenti, piu_vecchie) if righe else (None, None)
+        pagina = (righe, piu_recenti, piu_vecchie, corpo, tastiera)
+        if righe or cursore is None:
+            cache_liste.metti(chiave, pagina, versione=versione)
+        cache_liste.metti("totale", totale, versione=versione)
+    return pagina, totale
+
+def _chiave_riga(riga):
+    return (riga['data'], riga['id'])
+
+@db.osserva_inserimenti
+def aggiorna_cache_liste(inserite, totale):
+    # Le letture ancora in volo hanno visto i dati di prima: non salvano
+    cache_liste.nuova_versione()
+    cache_liste.metti("totale", totale)
+    minima = min(_chiave_riga(riga) for riga in inserite)
+    for chiave, pagina in cache_liste.voci():
+        if chiave == "totale":
+            continue
+        cursore, direzione = chiave
+        righe, piu_recenti, piu_vecchie, _, _ = pagina
+        if cursore is None:
+            # Di norma le segnalazioni nuove sono le più recenti: la prima
+            # pagina si aggiorna mettendole in cima, senza rileggere
+            if righe and minima < _chiave_riga(righe[0]):
+                cache_liste.rimuovi(chiave)
+                continue
+            unite = sorted(inserite, key=_chiave_riga, reverse=True) + list(righe)
+            righe = unite[:SEGNALAZIONI_PER_PAGINA]
+            piu_vecchie = piu_vecchie or len(unite) > SEGNALAZIONI_PER_PAGINA
+            cache_liste.metti(chiave, (righe, False, piu_vecchie, *componi_pagina_lista(righe, False, piu_vecchie)))
+            continue
+        # Le altre pagine cambiano solo se una riga nuova cade sotto il loro
+        # limite superiore: il cursore, o la riga più recente se la pagina
+        # è stata letta all'indietro e ha altre righe sopra
+        if direzione == "succ":
+            limite = cursore
+        elif piu_recenti:
+            limite = _chiave_riga(righe[0])
+        else:
+            limite = None
+        if limite is None or minima < limite:
+            cache_liste.rimuovi(chiave)
 
 async def lista(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM segnalazioni ORDER BY data DESC LIMIT 20")
-    segnalazioni = c.fetchall()
-    conn.close()
-    
-    if segnalazioni:
-        risposta = "*📋 Ultime 20 segnalazioni:*\n\n" + "\n\n".join(
-            f"🔸 *Turno {row['turno']}*\n"
-            f"📝 {row['segnalazione']}\n"
-            f"🕒 {row['data']}"
-            for row in segnalazioni
+    (righe, _, _, corpo, tastiera), totale = await pagina_lista(None, "succ")
+    
+    if righe:
+        await update.message.reply_text(
+            intestazione_lista(totale) + corpo, parse_mode='Markdown', reply_markup=tastiera
         )
-        await update.message.reply_text(risposta, parse_mode='Markdown')
     else:
         await update.message.reply_text("📝 Non ci sono segnalazioni registrate.")
 
-def genera_pdf():
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, "Registro Segnalazioni", ln=True, align='C')
-    pdf.set_font("Arial", size=12)
-    ora_generazione = datetime.now(get_tz_italia()).strftime("%d/%m/%Y %H:%M:%S")
-    pdf.cell(0, 10, f"Generato il: {ora_generazione}", ln=True, align='L')
-    pdf.ln(10)
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    # Prima ottieni il numero totale di segnalazioni
-    c.execute("SELECT COUNT(*) as total FROM segnalazioni")
-    total = c.fetchone()['total']
-    
-    # Poi ottieni tutte le segnalazioni ordinate per data
-    c.execute("SELECT * FROM segnalazioni ORDER BY data DESC")
-    segnalazioni = c.fetchall()
-    conn.close()
-    
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, f"Elenco Completo Segnalazioni (Totale: {total})", ln=True)
-    pdf.ln(5)
-    
-    for segnalazione in segnalazioni:
-        pdf.set_font("Arial", "B", 11)
-        pdf.cell(0, 7, f"Turno {segnalazione['turno']} - {segnalazione['data']}", ln=True)
-        pdf.set_font("Arial", size=10)
-        pdf.multi_cell(0, 7, segnalazione['segnalazione'])
-        pdf.ln(5)
-    
-    file_path = f"segnalazioni_{datetime.now(get_tz_italia()).strftime('%Y%m%d_%H%M%S')}.pdf"
-    pdf.output(file_path)
-    return file_path
+async def lista_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, direzione, data, id_riga = query.data.split(":")
+    (righe, _, _, corpo, tastiera), totale = await pagina_lista((int(data), int(id_riga)), direzione)
+    
+    if righe:
+        await query.edit_message_text(
+            intestazione_lista(totale) + corpo, parse_mode='Markdown', reply_markup=tastiera
+        )
+    else:
+        await query.edit_message_text("📝 Non ci sono altre segnalazioni.")
+
+# Le ricerche restano in chat_data: il callback_data (max 64 byte) porta
+# solo il numero della ricerca e il cursore
+RICERCHE_PER_CHAT = 20
+
+def leggi_ricerca(conn, espressione, turno, inizio, fine, soglie, finestra, cursore, direzione):
+    """
+    Una pagina di risultati nella finestra indicata. Oltre i bordi di una
+    finestra si passa alla successiva (più vecchia) o alla precedente.
+    Restituisce (righe, più_pertinenti, meno_pertinenti, finestra, soglie,
+    ricerca_incompleta), con le soglie delle finestre scoperte finora.
+    """
+    soglie = list(soglie)
+    if soglie[0] is None:
+        # Le segnalazioni arrivate dopo la ricerca non spostano le finestre
+        soglie[0] = prossimo_id(conn)
+    righe, piu_pertinenti, meno_pertinenti, successiva = cerca_segnalazioni(
+        conn, espressione, turno, inizio, fine, soglie[finestra], cursore, direzione, SEGNALAZIONI_PER_PAGINA
+    )
+    if not righe and cursore is not None:
+        if direzione == "succ" and successiva is not None:
+            finestra += 1
+            soglie[finestra:] = [successiva]
+            cursore = None
+        elif direzione == "prec" and finestra > 0:
+            finestra -= 1
+            cursore = None
+        if cursore is None:
+            righe, piu_pertinenti, meno_pertinenti, successiva = cerca_segnalazioni(
+                conn, espressione, turno, inizio, fine, soglie[finestra], None, direzione, SEGNALAZIONI_PER_PAGINA
+            )
+    if successiva is not None and len(soglie) == finestra + 1:
+        soglie.append(successiva)
+    return righe, piu_pertinenti, meno_pertinenti, finestra, soglie, ricerca_incompleta(conn)
+
+def componi_pagina_ricerca(numero, ricerca, righe, piu_pertinenti, meno_pertinenti, finestra, incompleta):
+    intestazione = f"*🔎 Risultati per:* {escape_markdown(' '.join(ricerca['termini']))}"
+    if ricerca['dal'] or ricerca['turno']:
+        intestazione += f"\n_{descrivi_filtri(ricerca['dal'], ricerca['al'], ricerca['turno'])}_"
+    altre_finestre = len(ricerca['soglie']) > finestra + 1
+    if finestra or altre_finestre:
+        intestazione += (
+            f"\n_Ordinati per pertinenza a gruppi di {CANDIDATI_RICERCA}, dai più recenti: "
+            f"gruppo {finestra + 1}{'' if altre_finestre else ', l’ultimo'}_"
+        )
+    if incompleta:
+        intestazione += "\n_⏳ Indicizzazione in corso: i risultati più vecchi potrebbero mancare_"
+    # Ai bordi di un gruppo i pulsanti portano al gruppo vicino
+    return componi_pagina(
+        intestazione, righe, piu_pertinenti or finestra > 0, meno_pertinenti or altre_finestre,
+        f"cerca:{numero}:{finestra}", "punteggio",
+        ("⬅️ Più pertinenti" if piu_pertinenti else "⬅️ Più recenti",
+         "Meno pertinenti ➡️" if meno_pertinenti else "Più vecchi ➡️"),
+    )
+
+async def esegui_ricerca(numero, ricerca, finestra=0, cursore=None, direzione="succ"):
+    inizio = limiti_giorno(ricerca['dal'])[0] if ricerca['dal'] else None
+    fine = limiti_giorno(ricerca['al'])[1] if ricerca['al'] else None
+    righe, piu_pertinenti, meno_pertinenti, finestra, soglie, incompleta = await db.leggi(
+        leggi_ricerca, espressione_fts(ricerca['termini']), ricerca['turno'],
+        inizio, fine, ricerca['soglie'], finestra, cursore, direzione
+    )
+    ricerca['soglie'] = soglie
+    if not righe:
+        return None, None
+    return componi_pagina_ricerca(
+        numero, ricerca, righe, piu_pertinenti, meno_pertinenti, finestra, incompleta
+    )
+
+async def cerca(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        dal, al, turno, termini = separa_filtri(context.args or [])
+        # Parole fatte solo di virgolette darebbero un MATCH vuoto, che FTS5 rifiuta
+        if not espressione_fts(termini):
+            raise ValueError("indica cosa cercare")
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ {e}\nUso: /cerca parole [GG/MM/AAAA] [GG/MM/AAAA] [A|B|C|D]"
+        )
+        return
+    
+    ricerche = context.chat_data.setdefault('ricerche', {})
+    numero = context.chat_data.get('ultima_ricerca', 0) + 1
+    context.chat_data['ultima_ricerca'] = numero
+    ricerche[numero] = {'termini': termini, 'dal': dal, 'al': al, 'turno': turno, 'soglie': [None]}
+    ricerche.pop(numero - RICERCHE_PER_CHAT, None)
+    
+    risposta, tastiera = await esegui_ricerca(numero, ricerche[numero])
+    if risposta:
+        await update.message.reply_text(risposta, parse_mode='Markdown', reply_markup=tastiera)
+    else:
+        await update.message.reply_text("🔎 Nessuna segnalazione trovata.")
+
+async def cerca_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    parti = query.data.split(":")
+    ricerca = context.chat_data.get('ricerche', {}).get(int(parti[1]))
+    # I pulsanti di prima dei gruppi non hanno il numero del gruppo
+    if ricerca is None or len(parti) != 6:
+        await query.edit_message_text("⌛ Ricerca scaduta, ripetila con /cerca.")
+        return
+    _, numero, finestra, direzione, punteggio, id_riga = parti
+    
+    risposta, tastiera = await esegui_ricerca(
+        int(numero), ricerca, int(finestra), (float(punteggio), int(id_riga)), direzione
+    )
+    if risposta:
+        await query.edit_message_text(risposta, parse_mode='Markdown', reply_markup=tastiera)
+    else:
+        await query.edit_message_text("🔎 Non ci sono altri risultati.")
 
 async def genera_PDF(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("🔄 Generazione PDF in corso...")
     try:
-        file_pdf = genera_pdf()
-        await update.message.reply_document(
-            document=open(file_pdf, 'rb'),
-            filename=f"segnalazioni_complete_{datetime.now(get_tz_italia()).strftime('%Y%m%d_%H%M')}.pdf",
-            caption="📊 Report completo di tutte le segnalazioni"
+        dal, al, turno = leggi_filtri(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ {e}\nUso: /genera_PDF [GG/MM/AAAA] [GG/MM/AAAA] [A|B|C|D]"
         )
-        os.remove(file_pdf)
+        return
+    
+    await update.message.reply_text("🔄 Generazione PDF in corso...")
+    try:
+        # Rendering nel process pool, con le pagine dei giorni chiusi in cache
+        async with motore_report.report(dal, al, turno) as (file_pdf, totale):
+            with open(file_pdf, 'rb') as documento:
+                await update.message.reply_document(
+                    document=documento,
+                    filename=f"segnalazioni_{'filtrate' if dal or turno else 'complete'}_{ora_italia().strftime('%Y%m%d_%H%M')}.pdf",
+                    caption=f"📊 Report di {totale} segnalazioni"
+                    + (f"\n{descrivi_filtri(dal, al, turno)}" if dal or turno else "")
+                )
     except Exception as e:
         await update.message.reply_text(f"❌ Errore nella generazione del PDF: {str(e)}")
 
+# Fuso e turno di /ora, validi fino al prossimo cambio turno o cambio d'ora
+cache_ora = CacheLRU("ora", 1)
+
 async def ora_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ora_attuale = datetime.now(get_tz_italia())
-    turno_attuale = calcola_turno()
+    epoch = time.time()
+    ora_attuale = da_epoch(epoch)
+    dettagli = cache_ora.leggi("ora")
+    if dettagli is None:
+        turno, offset = turno_attuale(epoch)
+        dettagli = (
+            f"Fuso Orario: {'Ora Legale (UTC+2)' if offset == 2 else 'Ora Solare (UTC+1)'}\n"
+            f"Turno Attuale: {turno}"
+        )
+        scadenza = min(calendario.finestra(epoch).fine, prossimo_cambio_ora(epoch))
+        cache_ora.metti("ora", dettagli, scadenza=scadenza)
     
     await update.message.reply_text(
         f"🕒 *Informazioni Orario Bot*\n\n"
         f"Data: {ora_attuale.strftime('%d/%m/%Y')}\n"
         f"Ora: {ora_attuale.strftime('%H:%M:%S')}\n"
-        f"Fuso Orario: {'Ora Legale (UTC+2)' if ora_attuale.tzinfo.utcoffset(None) == timedelta(hours=2) else 'Ora Solare (UTC+1)'}\n"
-        f"Turno Attuale: {turno_attuale}",
+        + dettagli,
         parse_mode='Markdown'
     )
 
+GIORNI_SETTIMANA = ['lun', 'mar', 'mer', 'gio', 'ven', 'sab', 'dom']
+
+GIORNI_STATISTICHE_MASSIMI = 31
+
+def fasce_piu_intense(conteggi, quante=3):
+    migliori = sorted(conteggi.items(), key=lambda c: c[1], reverse=True)[:quante]
+    return ", ".join(f"{fascia:02d}-{(fascia + 1) % 24:02d} ({n})" for fascia, n in migliori if n) or "—"
+
+def variazione(attuale, precedente):
+    if not precedente:
+        return "—"
+    return f"{(attuale - precedente) * 100 / precedente:+.0f}%"
+
+async def statistiche(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Conteggi letti solo dagli aggregati: la risposta costa uguale con
+    # cento o con milioni di segnalazioni
+    try:
+        giorni = int(context.args[0]) if context.args else 7
+    except ValueError:
+        giorni = 0
+    if not 1 <= giorni <= GIORNI_STATISTICHE_MASSIMI:
+        await update.message.reply_text(
+            f"❌ Uso: /statistiche [giorni], da 1 a {GIORNI_STATISTICHE_MASSIMI} (predefinito 7)"
+        )
+        return
+    
+    adesso = time.time()
+    oggi = da_epoch(adesso).date()
+    # Anche il periodo precedente, per il confronto
+    elenco = [oggi - timedelta(days=i) for i in range(2 * giorni)]
+    mese = oggi.year * 100 + oggi.month
+    mese_scorso = mese - 1 if oggi.month > 1 else (oggi.year - 1) * 100 + 12
+    # Le ore più intense recenti vengono dagli aggregati orari, tenuti una settimana
+    prima_ora = int(adesso) - int(adesso) % 3600 - (7 * 24 - 1) * 3600
+    dati = await db.leggi(
+        leggi_statistiche, chiave_giorno(elenco[-1]), prima_ora, (mese, mese_scorso)
+    )
+    
+    per_giorno = {}
+    for giorno, turno, conteggio in dati['giorni']:
+        per_giorno.setdefault(giorno, {})[turno] = conteggio
+    totali = [sum(per_giorno.get(chiave_giorno(g), {}).values()) for g in elenco]
+    massimo = max(totali[:giorni]) or 1
+    righe = [f"{'':9} {'':1}" + "".join(f"{t:>5}" for t in TURNI) + "  Tot"]
+    for giorno, totale in zip(elenco[:giorni], totali):
+        conteggi = per_giorno.get(chiave_giorno(giorno), {})
+        righe.append(
+            f"{GIORNI_SETTIMANA[giorno.weekday()]} {giorno.strftime('%d/%m')}  "
+            + "".join(f"{conteggi.get(t, 0):>5}" for t in TURNI)
+            + f"{totale:>5} {'█' * round(totale * 8 / massimo)}".rstrip()
+        )
+    
+    recenti = {}
+    for ora, conteggio in dati['ore']:
+        fascia = da_epoch(ora).hour
+        recenti[fascia] = recenti.get(fascia, 0) + conteggio
+    periodo, precedente = sum(totali[:giorni]), sum(totali[giorni:])
+    turni_totali = dati['turni']
+    
+    risposta = (
+        f"📊 *Statistiche segnalazioni*\n\n"
+        f"Totale: {sum(turni_totali.values())} ("
+        + ", ".join(f"{t} {turni_totali.get(t, 0)}" for t in TURNI) + ")\n"
+        f"Ultimi {giorni} giorni: {periodo} ({variazione(periodo, precedente)} sui {giorni} precedenti)\n"
+        f"Mese in corso: {dati['mesi'].get(mese, 0)}, mese scorso: {dati['mesi'].get(mese_scorso, 0)}\n"
+        f"Ore più intense, ultima settimana: {fasce_piu_intense(recenti)}\n"
+        f"Ore più intense, da sempre: {fasce_piu_intense(dict(dati['fasce']))}\n\n"
+        "```\n" + "\n".join(righe) + "\n```"
+    )
+    if dati['incomplete']:
+        risposta += "\n⏳ Conteggio delle segnalazioni precedenti ancora in corso: i totali sono parziali."
+    await update.message.reply_text(risposta, parse_mode='Markdown')
+
+async def turni_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Turno in corso e i successivi: quattro giorni di rotazione completa
+    righe = []
+    for indice, finestra in enumerate(calendario.prossime(time.time(), 8)):
+        inizio, fine = da_epoch(finestra.inizio), da_epoch(finestra.fine)
+        righe.append(
+            f"{'▶️' if indice == 0 else '🔸'} *Turno {finestra.turno}* "
+            f"{'🌙 notte' if finestra.notturno else '☀️ giorno'} "
+            f"{GIORNI_SETTIMANA[inizio.weekday()]} {inizio.strftime('%d/%m %H:%M')} → "
+            f"{GIORNI_SETTIMANA[fine.weekday()]} {fine.strftime('%d/%m %H:%M')}"
+        )
+    await update.message.reply_text(
+        "*🗓 Prossimi turni:*\n\n" + "\n".join(righe), parse_mode='Markdown'
+    )
+
+# Utenti autorizzati ai comandi di amministrazione, dal .env
+def is_admin(update: Update):
+    amministratori = {
+        int(id_utente) for id_utente in os.getenv("ADMIN_IDS", "").split(",") if id_utente.strip()
+    }
+    return update.effective_user is not None and update.effective_user.id in amministratori
+
+profilatore = Profilatore()
+
+async def profilo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔ Comando riservato agli amministratori.")
+        return
+    
+    azione = (context.args or ["stato"])[0].lower()
+    if azione == "avvia":
+        # Si campiona il thread corrente, cioè quello dell'event loop
+        if profilatore.avvia():
+            await update.message.reply_text("🔬 Profilatore avviato. Usa /profilo ferma per il report.")
+        else:
+            await update.message.reply_text("🔬 Il profilatore è già attivo.")
+    elif azione == "ferma":
+        if not profilatore.ferma():
+            await update.message.reply_text("🔬 Il profilatore non è attivo.")
+            return
+        await update.message.reply_text(f"```\n{profilatore.riepilogo()}\n```", parse_mode='Markdown')
+        await update.message.reply_document(
+            document=profilatore.collassato().encode(),
+            filename=f"profilo_{ora_italia().strftime('%Y%m%d_%H%M%S')}.txt",
+            caption="🔥 Stack collassati (flamegraph.pl, speedscope)"
+        )
+    else:
+        stato = "attivo" if profilatore.attivo else "spento"
+        await update.message.reply_text(
+            f"🔬 Profilatore {stato}, {profilatore.campioni} campioni.\n"
+            "Uso: /profilo avvia | ferma | stato"
+        )
+
 def main():
     print("Inizializzazione del bot...")
     
@@ -219,33 +588,127 @@ def main():
         raise ValueError("❌ Token non trovato! Controlla il file .env")
     
     # Crea l'applicazione
-    application = ApplicationBuilder().token(token).build()
+    # Gli update vengono gestiti in parallelo, così le insert concorrenti
+    # finiscono nello stesso commit del writer
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(True)
+        # Le risposte vengono cadenzate secondo i limiti di Telegram e
+        # ritentate dopo un RetryAfter invece di fallire
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(avvia_db)
+        .post_stop(chiudi_db)
+        .build()
+    )
     
     # Aggiungi gli handler
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("lista", lista))
+    application.add_handler(CallbackQueryHandler(lista_pagina, pattern=r"^lista:"))
+    application.add_handler(CommandHandler("cerca", cerca))
+    application.add_handler(CallbackQueryHandler(cerca_pagina, pattern=r"^cerca:"))
     application.add_handler(CommandHandler("genera_PDF", genera_PDF))
     application.add_handler(CommandHandler("aiuto", aiuto))
     application.add_handler(CommandHandler("ora", ora_bot))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, gestisci_messaggio))
+    application.add_handler(CommandHandler("turni", turni_bot))
+    application.add_handler(CommandHandler("statistiche", statistiche))
+    application.add_handler(CommandHandler("profilo", profilo))
+    # Solo i messaggi nuovi: le modifiche arrivano senza update.message
+    application.add_handler(MessageHandler(
+        filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, gestisci_messaggio
+    ))
+    
+    # Durata, update ed errori di ogni handler finiscono nelle metriche
+    strumenta_applicazione(application)
     
     # Avvia il bot
     print("🚀 Bot avviato con successo!")
-    print(f"Ora corrente del bot: {datetime.now(get_tz_italia()).strftime('%H:%M:%S')}")
+    print(f"Ora corrente del bot: {ora_italia().strftime('%H:%M:%S')}")
     
     # Gestione webhook per Render
     PORT = int(os.environ.get('PORT', '10000'))
     
     if os.environ.get('RENDER'):
-        print(f"Avvio in modalità webhook su porta {PORT}")
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            webhook_url=os.environ.get('WEBHOOK_URL')
-        )
+        print(f"Avvio in modalità webhook su porta {PORT} (metriche su /metrics)")
+        asyncio.run(esegui_webhook(
+            application,
+            PORT,
+            os.environ.get('WEBHOOK_URL'),
+            secret_token=os.environ.get('WEBHOOK_SECRET'),
+            avvio=avvia_db,
+            arresto=chiudi_db
+        ))
     else:
         print("Avvio in modalità polling")
         application.run_polling()
 
+# Operazioni massive da riga di comando, senza avviare il bot. Possono
+# girare anche a bot avviato: il bot se ne accorge entro pochi secondi
+def esegui_comando(argomenti):
+    parser = argparse.ArgumentParser(
+        prog="bot.py", description="Operazioni sulle segnalazioni. Senza argomenti avvia il bot."
+    )
+    sotto = parser.add_subparsers(dest="comando", required=True)
+    p = sotto.add_parser("importa", help="importa un file CSV o JSONL (- per lo standard input)")
+    p.add_argument("file")
+    p.add_argument("--formato", choices=["csv", "jsonl"])
+    p = sotto.add_parser("esporta", help="esporta in CSV o JSONL (- per lo standard output)")
+    p.add_argument("file")
+    p.add_argument("filtri", nargs="*", help="[GG/MM/AAAA] [GG/MM/AAAA] [A|B|C|D], come /genera_PDF")
+    p.add_argument("--formato", choices=["csv", "jsonl"])
+    p = sotto.add_parser("archivia", help="sposta i mesi vecchi nei database d'archivio")
+    p.add_argument("--mesi", type=int, default=6, help="mesi completi da tenere oltre a quello in corso")
+    sotto.add_parser("statistiche", help="ricostruisce gli aggregati di /statistiche dalle segnalazioni")
+    args = parser.parse_args(argomenti)
+
+    init_db()
+    conn = apri_connessione(db.path)
+    try:
+        inizio = time.perf_counter()
+        if args.comando == "importa":
+            formato = args.formato or formato_da_file(args.file)
+            try:
+                if args.file == "-":
+                    righe = importa(conn, sys.stdin, formato)
+                else:
+                    with open(args.file, newline="", encoding="utf-8") as sorgente:
+                        righe = importa(conn, sorgente, formato)
+            except ValueError as e:
+                # I lotti precedenti all'errore restano importati
+                sys.exit(f"❌ Importazione interrotta: {e}")
+            durata = time.perf_counter() - inizio
+            print(f"Importate {righe} segnalazioni in {durata:.1f} s ({righe / max(durata, 1e-9):.0f}/s)", file=sys.stderr)
+            indicizzate = completa_indice(conn)
+            print(f"Indice di ricerca completato ({indicizzate} segnalazioni)", file=sys.stderr)
+        elif args.comando == "esporta":
+            try:
+                dal, al, turno = leggi_filtri(args.filtri)
+            except ValueError as e:
+                parser.error(str(e))
+            limiti = (
+                limiti_giorno(dal)[0] if dal else None,
+                limiti_giorno(al)[1] if al else None,
+            )
+            formato = args.formato or formato_da_file(args.file)
+            if args.file == "-":
+                righe = esporta(conn, sys.stdout, formato, *limiti, turno)
+            else:
+                with open(args.file, "w", newline="", encoding="utf-8") as destinazione:
+                    righe = esporta(conn, destinazione, formato, *limiti, turno)
+            print(f"Esportate {righe} segnalazioni in {time.perf_counter() - inizio:.1f} s", file=sys.stderr)
+        elif args.comando == "archivia":
+            for anno, mese, righe in archivia(conn, args.mesi):
+                print(f"Archiviato {mese:02d}/{anno}: {righe} segnalazioni", file=sys.stderr)
+        else:
+            ricostruisci_statistiche(conn)
+            completa_statistiche(conn)
+            print(f"Statistiche ricostruite in {time.perf_counter() - inizio:.1f} s", file=sys.stderr)
+    finally:
+        conn.close()
+
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1:
+        esegui_comando(sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,66 @@
+import time
+from collections import OrderedDict
+
+from metriche import cache_richieste, registro
+
+
+class CacheLRU:
+    """
+    Cache in memoria delle risposte già composte, limitata a capacita voci:
+    oltre il limite si scarta la meno usata di recente.
+
+    Le voci possono avere una scadenza (epoch). Chi modifica i dati da cui
+    dipendono le voci chiama nuova_versione(): una lettura iniziata prima
+    della modifica non può più salvare il suo risultato, ormai vecchio.
+    Tutti gli accessi avvengono dal thread dell'event loop.
+    """
+
+    def __init__(self, nome, capacita):
+        self.nome = nome
+        self.capacita = capacita
+        self.versione = 0
+        self.espulse = 0
+        self._voci = OrderedDict()
+        registro.raccolta(lambda: [(
+            f"vigilbot_cache_{self.nome}_voci", "gauge", f"Voci nella cache {self.nome}", len(self._voci),
+        )])
+
+    def __len__(self):
+        return len(self._voci)
+
+    def leggi(self, chiave):
+        voce = self._voci.get(chiave)
+        if voce is not None and voce[1] is not None and voce[1] <= time.time():
+            del self._voci[chiave]
+            voce = None
+        if voce is None:
+            cache_richieste.incrementa(cache=self.nome, esito="miss")
+            return None
+        self._voci.move_to_end(chiave)
+        cache_richieste.incrementa(cache=self.nome, esito="hit")
+        return voce[0]
+
+    def metti(self, chiave, valore, scadenza=None, versione=None):
+        """Salva la voce, a meno che i dati siano cambiati dalla versione letta."""
+        if versione is not None and versione != self.versione:
+            return False
+        self._voci[chiave] = (valore, scadenza)
+        self._voci.move_to_end(chiave)
+        while len(self._voci) > self.capacita:
+            self._voci.popitem(last=False)
+            self.espulse += 1
+        return True
+
+    def voci(self):
+        """Copia delle coppie (chiave, valore), da scorrere mentre si modifica la cache."""
+        return [(chiave, voce[0]) for chiave, voce in self._voci.items()]
+
+    def rimuovi(self, chiave):
+        self._voci.pop(chiave, None)
+
+    def nuova_versione(self):
+        self.versione += 1
+
+    def svuota(self):
+        self._voci.clear()
+        self.versione += 1
@@ -0,0 +1,12 @@
+import os
+import shutil
+import tempfile
+
+# Il bot legge DB_PATH all'import: i test non devono mai toccare segnalazioni.db
+CARTELLA = tempfile.mkdtemp(prefix="test_segnalazioni_")
+os.environ["DB_PATH"] = os.path.join(CARTELLA, "test.db")
+os.environ["CACHE_REPORT"] = os.path.join(CARTELLA, "cache_report")
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(CARTELLA, ignore_errors=True)
@@ -0,0 +1,1068 @@
+import asyncio
+import bisect
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from metriche import durata_db, registro, righe_scritte
+from orario import a_epoch, da_epoch
+
+# Percorso predefinito del database, sovrascrivibile con DB_PATH nel .env
+DB_PATH_PREDEFINITO = "segnalazioni.db"
+
+
+def percorso_db():
+    return os.getenv("DB_PATH", DB_PATH_PREDEFINITO)
+
+
+def apri_connessione(path=None):
+    """
+    Apre una connessione SQLite configurata per l'uso concorrente:
+    WAL permette letture parallele mentre il writer committa.
+    """
+    conn = sqlite3.connect(path or percorso_db(), check_same_thread=False, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    # FULL rende ogni commit durevole; il costo dell'fsync viene
+    # ammortizzato dal writer che committa le insert a gruppi
+    conn.execute("PRAGMA synchronous=FULL")
+    return conn
+
+
+class Database:
+    """
+    Sottosistema di persistenza del bot.
+
+    Le letture girano su un pool di connessioni a lunga durata (una per
+    thread), le scritture su un unico thread dedicato. Le insert delle
+    segnalazioni passano da una coda asincrona: il task writer le raccoglie
+    e le committa insieme, e ogni chiamante viene risvegliato solo quando
+    il suo gruppo è su disco.
+    """
+
+    def __init__(self, path=None, dimensione_pool=4, dimensione_lotto=256):
+        self.path = path or percorso_db()
+        self.dimensione_pool = dimensione_pool
+        self.dimensione_lotto = dimensione_lotto
+        self._locale = threading.local()
+        self._connessioni = []
+        self._lock_connessioni = threading.Lock()
+        self._letture = None
+        self._scritture = None
+        self._coda = None
+        self._writer = None
+        self._osservatori = []
+
+    def _apri_connessione_thread(self):
+        conn = apri_connessione(self.path)
+        self._locale.conn = conn
+        with self._lock_connessioni:
+            self._connessioni.append(conn)
+
+    def _esegui(self, funzione, args):
+        return funzione(self._locale.conn, *args)
+
+    async def avvia(self):
+        if self._writer is not None:
+            return
+        self._letture = ThreadPoolExecutor(
+            max_workers=self.dimensione_pool,
+            thread_name_prefix="db-lettura",
+            initializer=self._apri_connessione_thread,
+        )
+        self._scritture = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="db-scrittura",
+            initializer=self._apri_connessione_thread,
+        )
+        self._coda = asyncio.Queue()
+        self._writer = asyncio.create_task(self._ciclo_writer())
+
+    async def chiudi(self):
+        if self._writer is None:
+            return
+        # Il writer svuota la coda prima di uscire
+        await self._coda.put(None)
+        await self._writer
+        self._writer = None
+        self._letture.shutdown(wait=True)
+        self._scritture.shutdown(wait=True)
+        with self._lock_connessioni:
+            for conn in self._connessioni:
+                conn.close()
+            self._connessioni.clear()
+
+    async def _misura(self, executor, funzione, args, nome):
+        inizio = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, self._esegui, funzione, args
+            )
+        finally:
+            if registro.attivo:
+                durata_db.osserva(time.perf_counter() - inizio, operazione=nome)
+
+    async def leggi(self, funzione, *args):
+        """Esegue funzione(conn, *args) su una connessione del pool di lettura."""
+        return await self._misura(self._letture, funzione, args, funzione.__name__)
+
+    async def scrivi(self, funzione, *args):
+        """Esegue funzione(conn, *args) sul thread di scrittura, in una transazione."""
+        return await self._misura(
+            self._scritture, _in_transazione, (funzione, args), funzione.__name__
+        )
+
+    async def indicizza_ricerca(self, blocco=5000, pausa=0.05):
+        """
+        Completa in background l'indice full-text delle righe esistenti,
+        un blocco per transazione così le insert non restano in attesa.
+        """
+        indicizzate = 0
+        while righe := await self.scrivi(indicizza_arretrati, blocco):
+            indicizzate += righe
+            await asyncio.sleep(pausa)
+        if indicizzate:
+            print(f"Indice di ricerca completato ({indicizzate} segnalazioni)")
+
+    async def completa_statistiche(self, blocco=5000, pausa=0.05):
+        """Conta in background negli aggregati le righe ancora escluse, a blocchi."""
+        contate = 0
+        while righe := await self.scrivi(conta_arretrati_statistiche, blocco):
+            contate += righe
+            await asyncio.sleep(pausa)
+        if contate:
+            print(f"Statistiche ricostruite ({contate} segnalazioni)")
+
+    def osserva_inserimenti(self, funzione):
+        """
+        Registra funzione(righe, totale), chiamata sul loop dopo ogni commit
+        del writer con le righe inserite e il totale delle segnalazioni.
+        """
+        self._osservatori.append(funzione)
+        return funzione
+
+    async def inserisci_segnalazione(self, turno, segnalazione, data):
+        """Accoda una segnalazione e ne restituisce l'id dopo il commit del gruppo."""
+        futuro = asyncio.get_running_loop().create_future()
+        await self._coda.put(((turno, segnalazione, data), futuro))
+        return await futuro
+
+    async def _ciclo_writer(self):
+        chiuso = False
+        while not chiuso:
+            elemento = await self._coda.get()
+            if elemento is None:
+                break
+            lotto = [elemento]
+            # Raccoglie tutto ciò che è già in coda, fino alla dimensione del lotto
+            while len(lotto) < self.dimensione_lotto and not self._coda.empty():
+                elemento = self._coda.get_nowait()
+                if elemento is None:
+                    chiuso = True
+                    break
+                lotto.append(elemento)
+
+            righe = [parametri for parametri, _ in lotto]
+            try:
+                ids, totale = await self.scrivi(_inserisci_righe, righe)
+            except Exception as e:
+                for _, futuro in lotto:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+                continue
+            righe_scritte.incrementa(len(ids))
+            if self._osservatori:
+                inserite = [
+                    {'id': id_riga, 'turno': turno, 'segnalazione': segnalazione, 'data': data}
+                    for id_riga, (turno, segnalazione, data) in zip(ids, righe)
+                ]
+                for funzione in self._osservatori:
+                    try:
+                        funzione(inserite, totale)
+                    except Exception as e:
+                        print(f"Errore in un osservatore delle insert: {e}")
+            for (_, futuro), id_riga in zip(lotto, ids):
+                if not futuro.done():
+                    futuro.set_result(id_riga)
+
+
+def _in_transazione(conn, funzione, args):
+    try:
+        risultato = funzione(conn, *args)
+        conn.commit()
+        return risultato
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _inserisci_righe(conn, righe):
+    c = conn.cursor()
+    ids = []
+    for riga in righe:
+        c.execute(
+            "INSERT INTO segnalazioni (turno, segnalazione, data) VALUES (?, ?, ?)", riga
+        )
+        ids.append(c.lastrowid)
+    aggiorna_statistiche(conn, righe)
+    # Letto nella stessa transazione: è il totale esatto dopo il commit
+    return ids, conta_segnalazioni(conn)
+
+
+# --- Migrazioni dello schema ---
+#
+# La versione corrente è salvata in PRAGMA user_version. Ogni migrazione
+# porta lo schema dalla versione i alla i + 1 ed è eseguita una sola volta,
+# dentro la stessa transazione che aggiorna user_version.
+
+def _esegui_script(conn, script):
+    # A differenza di executescript non committa: resta nella transazione
+    istruzione = ""
+    for riga in script.splitlines(keepends=True):
+        istruzione += riga
+        if sqlite3.complete_statement(istruzione):
+            conn.execute(istruzione)
+            istruzione = ""
+    if istruzione.strip():
+        conn.execute(istruzione)
+
+
+def _migrazione_1(conn):
+    # Schema originale: data come testo in ora locale
+    conn.execute('''CREATE TABLE IF NOT EXISTS segnalazioni
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     turno TEXT,
+                     segnalazione TEXT,
+                     data TEXT)''')
+
+
+def _epoch_da_testo(testo):
+    """Converte 'YYYY-MM-DD HH:MM:SS' in ora italiana in secondi epoch UTC."""
+    if testo is None:
+        return None
+    return a_epoch(datetime.strptime(testo, "%Y-%m-%d %H:%M:%S"))
+
+
+def _migrazione_2(conn):
+    # data diventa un epoch intero indicizzato, con indici per la
+    # paginazione a cursore (data, id) e per i filtri per turno
+    conn.create_function("epoch_da_testo", 1, _epoch_da_testo, deterministic=True)
+    _esegui_script(conn, '''
+        CREATE TABLE segnalazioni_v2
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+             turno TEXT NOT NULL,
+             segnalazione TEXT NOT NULL,
+             data INTEGER NOT NULL);
+        INSERT INTO segnalazioni_v2 (id, turno, segnalazione, data)
+            SELECT id, COALESCE(turno, ''), COALESCE(segnalazione, ''),
+                   COALESCE(epoch_da_testo(data), 0)
+            FROM segnalazioni;
+        DROP TABLE segnalazioni;
+        ALTER TABLE segnalazioni_v2 RENAME TO segnalazioni;
+        CREATE INDEX idx_segnalazioni_data ON segnalazioni (data, id);
+        CREATE INDEX idx_segnalazioni_turno_data ON segnalazioni (turno, data, id);
+    ''')
+
+
+def _migrazione_3(conn):
+    # Conteggio delle righe mantenuto dai trigger, per evitare COUNT(*)
+    _esegui_script(conn, '''
+        CREATE TABLE contatori (nome TEXT PRIMARY KEY, valore INTEGER NOT NULL);
+        INSERT INTO contatori (nome, valore)
+            SELECT 'segnalazioni', COUNT(*) FROM segnalazioni;
+        CREATE TRIGGER segnalazioni_conta_insert AFTER INSERT ON segnalazioni
+        BEGIN
+            UPDATE contatori SET valore = valore + 1 WHERE nome = 'segnalazioni';
+        END;
+        CREATE TRIGGER segnalazioni_conta_delete AFTER DELETE ON segnalazioni
+        BEGIN
+            UPDATE contatori SET valore = valore - 1 WHERE nome = 'segnalazioni';
+        END;
+    ''')
+
+
+def _migrazione_4(conn):
+    # Indice full-text a contenuto esterno, sincronizzato dai trigger.
+    # Le righe già presenti vengono indicizzate in background a blocchi,
+    # dalla più recente: contatori.fts_arretrati è il primo id ancora da
+    # indicizzare (escluso), e i trigger non toccano le righe sotto soglia.
+    _esegui_script(conn, '''
+        CREATE VIRTUAL TABLE segnalazioni_fts USING fts5(
+            segnalazione,
+            content='segnalazioni',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3 4 5 6'
+        );
+        INSERT INTO contatori (nome, valore)
+            SELECT 'fts_arretrati', COALESCE(MAX(id), 0) + 1 FROM segnalazioni;
+        CREATE TRIGGER segnalazioni_fts_insert AFTER INSERT ON segnalazioni
+        BEGIN
+            INSERT INTO segnalazioni_fts (rowid, segnalazione)
+                VALUES (new.id, new.segnalazione);
+        END;
+        CREATE TRIGGER segnalazioni_fts_delete AFTER DELETE ON segnalazioni
+        WHEN old.id >= COALESCE(
+            (SELECT valore FROM contatori WHERE nome = 'fts_arretrati'), 0)
+        BEGIN
+            INSERT INTO segnalazioni_fts (segnalazioni_fts, rowid, segnalazione)
+                VALUES ('delete', old.id, old.segnalazione);
+        END;
+        CREATE TRIGGER segnalazioni_fts_update AFTER UPDATE OF segnalazione ON segnalazioni
+        WHEN old.id >= COALESCE(
+            (SELECT valore FROM contatori WHERE nome = 'fts_arretrati'), 0)
+        BEGIN
+            INSERT INTO segnalazioni_fts (segnalazioni_fts, rowid, segnalazione)
+                VALUES ('delete', old.id, old.segnalazione);
+            INSERT INTO segnalazioni_fts (rowid, segnalazione)
+                VALUES (new.id, new.segnalazione);
+        END;
+    ''')
+
+
+def _migrazione_5(conn):
+    # Le righe fuori dall'indice full-text diventano intervalli di id
+    # [inizio, fine): oltre alle righe precedenti alla migrazione 4 ci
+    # finiscono quelle delle importazioni massive, indicizzate dopo a
+    # blocchi. I trigger saltano le righe che cadono in un intervallo; in
+    # inserimento ci cadono solo le righe importate, che importa_righe
+    # conta una volta per blocco. Conteggio e full-text in inserimento
+    # stanno in un solo trigger, così la condizione si valuta una volta.
+    # archivi elenca i database d'archivio con le segnalazioni più vecchie.
+    _esegui_script(conn, '''
+        CREATE TABLE fts_da_indicizzare (inizio INTEGER PRIMARY KEY, fine INTEGER NOT NULL);
+        INSERT INTO fts_da_indicizzare (inizio, fine)
+            SELECT 0, valore FROM contatori WHERE nome = 'fts_arretrati';
+        DELETE FROM contatori WHERE nome = 'fts_arretrati';
+        DROP TRIGGER segnalazioni_conta_insert;
+        DROP TRIGGER segnalazioni_fts_insert;
+        DROP TRIGGER segnalazioni_fts_delete;
+        DROP TRIGGER segnalazioni_fts_update;
+        CREATE TRIGGER segnalazioni_insert AFTER INSERT ON segnalazioni
+        WHEN new.id >= COALESCE((SELECT fine FROM fts_da_indicizzare
+            WHERE inizio <= new.id ORDER BY inizio DESC LIMIT 1), 0)
+        BEGIN
+            UPDATE contatori SET valore = valore + 1 WHERE nome = 'segnalazioni';
+            INSERT INTO segnalazioni_fts (rowid, segnalazione)
+                VALUES (new.id, new.segnalazione);
+        END;
+        CREATE TRIGGER segnalazioni_fts_delete AFTER DELETE ON segnalazioni
+        WHEN old.id >= COALESCE((SELECT fine FROM fts_da_indicizzare
+            WHERE inizio <= old.id ORDER BY inizio DESC LIMIT 1), 0)
+        BEGIN
+            INSERT INTO segnalazioni_fts (segnalazioni_fts, rowid, segnalazione)
+                VALUES ('delete', old.id, old.segnalazione);
+        END;
+        CREATE TRIGGER segnalazioni_fts_update AFTER UPDATE OF segnalazione ON segnalazioni
+        WHEN old.id >= COALESCE((SELECT fine FROM fts_da_indicizzare
+            WHERE inizio <= old.id ORDER BY inizio DESC LIMIT 1), 0)
+        BEGIN
+            INSERT INTO segnalazioni_fts (segnalazioni_fts, rowid, segnalazione)
+                VALUES ('delete', old.id, old.segnalazione);
+            INSERT INTO segnalazioni_fts (rowid, segnalazione)
+                VALUES (new.id, new.segnalazione);
+        END;
+        CREATE TABLE archivi
+            (schema TEXT PRIMARY KEY,
+             file TEXT NOT NULL,
+             inizio INTEGER NOT NULL,
+             fine INTEGER NOT NULL,
+             righe INTEGER NOT NULL);
+        INSERT INTO contatori (nome, valore) VALUES ('modifiche_esterne', 0);
+    ''')
+
+
+def _migrazione_6(conn):
+    # Aggregati per /statistiche, aggiornati a ogni insert dal writer e
+    # dalle importazioni. Le righe già presenti vengono contate in
+    # background a blocchi, dalla più recente: contatori.statistiche_arretrate
+    # è il primo id ancora da contare (escluso)
+    _esegui_script(conn, '''
+        CREATE TABLE statistiche_ore
+            (ora INTEGER NOT NULL, turno TEXT NOT NULL, conteggio INTEGER NOT NULL,
+             PRIMARY KEY (ora, turno)) WITHOUT ROWID;
+        CREATE TABLE statistiche_giorni
+            (giorno INTEGER NOT NULL, turno TEXT NOT NULL, conteggio INTEGER NOT NULL,
+             PRIMARY KEY (giorno, turno)) WITHOUT ROWID;
+        CREATE TABLE statistiche_mesi
+            (mese INTEGER NOT NULL, turno TEXT NOT NULL, conteggio INTEGER NOT NULL,
+             PRIMARY KEY (mese, turno)) WITHOUT ROWID;
+        CREATE TABLE statistiche_fasce
+            (fascia INTEGER NOT NULL, turno TEXT NOT NULL, conteggio INTEGER NOT NULL,
+             PRIMARY KEY (fascia, turno)) WITHOUT ROWID;
+        INSERT INTO contatori (nome, valore)
+            SELECT 'statistiche_arretrate', COALESCE(
+                (SELECT seq FROM sqlite_sequence WHERE name = 'segnalazioni'), 0) + 1;
+    ''')
+
+
+MIGRAZIONI = [_migrazione_1, _migrazione_2, _migrazione_3, _migrazione_4, _migrazione_5, _migrazione_6]
+
+
+def migra(conn):
+    """Applica le migrazioni mancanti e restituisce la versione finale dello schema."""
+    versione = conn.execute("PRAGMA user_version").fetchone()[0]
+    for numero, migrazione in enumerate(MIGRAZIONI[versione:], start=versione + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migrazione(conn)
+            conn.execute(f"PRAGMA user_version = {numero}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        print(f"Schema database aggiornato alla versione {numero}")
+    return max(versione, len(MIGRAZIONI))
+
+
+def indicizza_arretrati(conn, blocco):
+    """
+    Indicizza nel full-text il prossimo blocco di righe ancora fuori
+    dall'indice, dalla più recente. Restituisce quante righe ha
+    indicizzato, 0 quando l'indice è completo.
+
+    Bot e importazione da riga di comando possono completare l'indice
+    insieme: la transazione si apre qui, IMMEDIATE, prima di leggere gli
+    intervalli, così nessun altro processo li cambia tra lettura e
+    scrittura. Chi chiama la chiude.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    while True:
+        intervallo = conn.execute(
+            "SELECT inizio, fine FROM fts_da_indicizzare ORDER BY fine DESC LIMIT 1"
+        ).fetchone()
+        if intervallo is None:
+            return 0
+        inizio, fine = intervallo
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM segnalazioni WHERE id >= ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (inizio, fine, blocco),
+        )]
+        if ids:
+            break
+        conn.execute("DELETE FROM fts_da_indicizzare WHERE inizio = ?", (inizio,))
+    conn.execute(
+        "INSERT INTO segnalazioni_fts (rowid, segnalazione) "
+        "SELECT id, segnalazione FROM segnalazioni WHERE id >= ? AND id < ?",
+        (ids[-1], fine),
+    )
+    if ids[-1] > inizio:
+        conn.execute("UPDATE fts_da_indicizzare SET fine = ? WHERE inizio = ?", (ids[-1], inizio))
+    else:
+        conn.execute("DELETE FROM fts_da_indicizzare WHERE inizio = ?", (inizio,))
+    return len(ids)
+
+
+def ricerca_incompleta(conn):
+    return conn.execute("SELECT 1 FROM fts_da_indicizzare LIMIT 1").fetchone() is not None
+
+
+def conta_segnalazioni(conn):
+    """Segnalazioni nel database principale e negli archivi."""
+    riga = conn.execute(
+        "SELECT valore FROM contatori WHERE nome = 'segnalazioni'"
+    ).fetchone()
+    archiviate = conn.execute("SELECT COALESCE(SUM(righe), 0) FROM archivi").fetchone()[0]
+    return (riga[0] if riga else 0) + archiviate
+
+
+def modifiche_esterne(conn):
+    """Contatore delle importazioni e archiviazioni fatte da altri processi."""
+    riga = conn.execute(
+        "SELECT valore FROM contatori WHERE nome = 'modifiche_esterne'"
+    ).fetchone()
+    return riga[0] if riga else 0
+
+
+def _segna_modifica_esterna(conn):
+    conn.execute("UPDATE contatori SET valore = valore + 1 WHERE nome = 'modifiche_esterne'")
+
+
+def importa_righe(conn, righe):
+    """
+    Inserisce un blocco di (turno, segnalazione, data) in un'unica
+    transazione. Gli id sono assegnati qui, consecutivi, e l'intervallo
+    resta fuori dai trigger: il contatore si aggiorna una volta sola e
+    indicizza_arretrati completa dopo l'indice full-text, molto più in
+    fretta che riga per riga.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        primo = conn.execute(
+            "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'segnalazioni'), 0), "
+            "COALESCE((SELECT MAX(id) FROM segnalazioni), 0)) + 1"
+        ).fetchone()[0]
+        fine = primo + len(righe)
+        # Blocchi consecutivi allungano lo stesso intervallo
+        if not conn.execute(
+            "UPDATE fts_da_indicizzare SET fine = ? WHERE fine = ?", (fine, primo)
+        ).rowcount:
+            conn.execute("INSERT INTO fts_da_indicizzare (inizio, fine) VALUES (?, ?)", (primo, fine))
+        conn.executemany(
+            "INSERT INTO segnalazioni (id, turno, segnalazione, data) VALUES (?, ?, ?, ?)",
+            ((primo + i, *riga) for i, riga in enumerate(righe)),
+        )
+        conn.execute(
+            "UPDATE contatori SET valore = valore + ? WHERE nome = 'segnalazioni'", (len(righe),)
+        )
+        aggiorna_statistiche(conn, righe)
+        _segna_modifica_esterna(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return primo
+
+
+# --- Statistiche ---
+#
+# Ogni insert aggiorna quattro aggregati per turno: ore (epoch UTC
+# dell'ora), giorni (AAAAMMGG) e mesi (AAAAMM) in ora italiana, e fasce
+# orarie (0-23) di tutta la storia. Gli offset italiani sono di ore
+# intere, quindi un'ora UTC cade in un solo giorno e una sola fascia
+# locale. Le ore si tengono per ORE_STATISTICHE ore e i giorni per
+# GIORNI_STATISTICHE giorni: oltre restano i giorni, poi i mesi.
+
+ORE_STATISTICHE = 8 * 24
+GIORNI_STATISTICHE = 400
+
+_UPSERT_STATISTICHE = (
+    "INSERT INTO {tabella} ({chiave}, turno, conteggio) VALUES (?, ?, ?) "
+    "ON CONFLICT ({chiave}, turno) DO UPDATE SET conteggio = conteggio + excluded.conteggio"
+)
+
+
+def chiave_giorno(giorno):
+    return giorno.year * 10000 + giorno.month * 100 + giorno.day
+
+
+def limiti_statistiche(adesso=None):
+    """Prima ora (epoch) e primo giorno (AAAAMMGG) ancora tenuti negli aggregati."""
+    adesso = time.time() if adesso is None else adesso
+    ora = int(adesso) - int(adesso) % 3600 - (ORE_STATISTICHE - 1) * 3600
+    return ora, chiave_giorno(da_epoch(adesso).date() - timedelta(days=GIORNI_STATISTICHE - 1))
+
+
+def aggiorna_statistiche(conn, righe):
+    """Aggiunge agli aggregati le righe (turno, segnalazione, data), raggruppate per ora."""
+    per_ora = Counter((data - data % 3600, turno) for turno, _, data in righe)
+    if not per_ora:
+        return
+    prima_ora, primo_giorno = limiti_statistiche()
+    ore, giorni, mesi, fasce = [], Counter(), Counter(), Counter()
+    for (ora, turno), conteggio in per_ora.items():
+        locale = da_epoch(ora)
+        giorno = chiave_giorno(locale)
+        if ora >= prima_ora:
+            ore.append((ora, turno, conteggio))
+        if giorno >= primo_giorno:
+            giorni[giorno, turno] += conteggio
+        mesi[locale.year * 100 + locale.month, turno] += conteggio
+        fasce[locale.hour, turno] += conteggio
+    for tabella, chiave, valori in (
+        ("statistiche_ore", "ora", ore),
+        ("statistiche_giorni", "giorno", [(*k, v) for k, v in giorni.items()]),
+        ("statistiche_mesi", "mese", [(*k, v) for k, v in mesi.items()]),
+        ("statistiche_fasce", "fascia", [(*k, v) for k, v in fasce.items()]),
+    ):
+        if valori:
+            conn.executemany(_UPSERT_STATISTICHE.format(tabella=tabella, chiave=chiave), valori)
+    # Il passaggio da ore a giorni a mesi: il dettaglio vecchio si scarta
+    conn.execute("DELETE FROM statistiche_ore WHERE ora < ?", (prima_ora,))
+    conn.execute("DELETE FROM statistiche_giorni WHERE giorno < ?", (primo_giorno,))
+
+
+def conta_arretrati_statistiche(conn, blocco):
+    """
+    Conta negli aggregati le righe del prossimo blocco di id ancora
+    escluso, archivi compresi. Restituisce quante righe ha contato, 0
+    quando gli aggregati sono completi.
+
+    Bot e riga di comando possono contare insieme. Le letture agganciano
+    gli archivi, cosa che SQLite non permette dentro una transazione, e
+    restano fuori dalla scrittura. Il segnaposto quindi si sposta solo se
+    vale ancora quanto letto; altrimenti il blocco è già stato contato da
+    altri, si annulla e si riprova. Va chiamata fuori da una transazione.
+    """
+    while True:
+        riga = conn.execute(
+            "SELECT valore FROM contatori WHERE nome = 'statistiche_arretrate'"
+        ).fetchone()
+        if riga is None:
+            return 0
+        # Salta i buchi negli id, per esempio dopo un'importazione con id alti
+        massimi = [
+            conn.execute(f"SELECT MAX(id) FROM {schema}.segnalazioni WHERE id < ?", (riga[0],)).fetchone()[0]
+            for schema in partizioni(conn)
+        ]
+        fine = max((m + 1 for m in massimi if m is not None), default=0)
+        inizio = max(0, fine - blocco)
+        # Durante un'archiviazione una riga può stare in due partizioni
+        righe = {}
+        for schema in partizioni(conn):
+            for id_riga, turno, data in conn.execute(
+                f"SELECT id, turno, data FROM {schema}.segnalazioni WHERE id >= ? AND id < ?",
+                (inizio, fine),
+            ):
+                righe[id_riga] = (turno, None, data)
+        aggiorna_statistiche(conn, righe.values())
+        if inizio > 0:
+            spostato = conn.execute(
+                "UPDATE contatori SET valore = ? WHERE nome = 'statistiche_arretrate' AND valore = ?",
+                (inizio, riga[0]),
+            ).rowcount
+        else:
+            spostato = conn.execute(
+                "DELETE FROM contatori WHERE nome = 'statistiche_arretrate' AND valore = ?", (riga[0],)
+            ).rowcount
+        if spostato:
+            return len(righe)
+        conn.rollback()
+
+
+def ricostruisci_statistiche(conn):
+    """Azzera gli aggregati: conta_arretrati_statistiche li riempie di nuovo a blocchi."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for tabella in ("statistiche_ore", "statistiche_giorni", "statistiche_mesi", "statistiche_fasce"):
+            conn.execute(f"DELETE FROM {tabella}")
+        conn.execute(
+            "INSERT OR REPLACE INTO contatori (nome, valore) SELECT 'statistiche_arretrate', "
+            "COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'segnalazioni'), 0) + 1"
+        )
+        _segna_modifica_esterna(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def statistiche_incomplete(conn):
+    return conn.execute(
+        "SELECT 1 FROM contatori WHERE nome = 'statistiche_arretrate'"
+    ).fetchone() is not None
+
+
+def leggi_statistiche(conn, primo_giorno, prima_ora, mesi):
+    """
+    Tutto ciò che serve a /statistiche, letto solo dagli aggregati: il
+    costo dipende dal periodo mostrato, non dal numero di segnalazioni.
+    """
+    return {
+        'turni': dict(conn.execute(
+            "SELECT turno, SUM(conteggio) FROM statistiche_fasce GROUP BY turno"
+        ).fetchall()),
+        'giorni': conn.execute(
+            "SELECT giorno, turno, conteggio FROM statistiche_giorni WHERE giorno >= ?",
+            (primo_giorno,),
+        ).fetchall(),
+        'ore': conn.execute(
+            "SELECT ora, SUM(conteggio) FROM statistiche_ore WHERE ora >= ? GROUP BY ora",
+            (prima_ora,),
+        ).fetchall(),
+        'fasce': conn.execute(
+            "SELECT fascia, SUM(conteggio) FROM statistiche_fasce GROUP BY fascia"
+        ).fetchall(),
+        'mesi': dict(conn.execute(
+            f"SELECT mese, SUM(conteggio) FROM statistiche_mesi "
+            f"WHERE mese IN ({', '.join('?' * len(mesi))}) GROUP BY mese",
+            mesi,
+        ).fetchall()),
+        'incomplete': statistiche_incomplete(conn),
+    }
+
+
+# --- Partizioni d'archivio ---
+#
+# I mesi più vecchi vengono spostati in database d'archivio, uno per anno,
+# con le stesse righe e gli stessi id. Le letture scorrono il database
+# principale e gli archivi che coprono il periodo richiesto, e uniscono i
+# risultati. SQLite aggancia al massimo 10 database per connessione: gli
+# archivi si agganciano uno alla volta, solo quando servono, e oltre
+# MASSIMO_ARCHIVI_AGGANCIATI si sganciano quelli agganciati da più tempo.
+
+MASSIMO_ARCHIVI_AGGANCIATI = 8
+
+def _file_principale(conn):
+    return next(file for _, nome, file in conn.execute("PRAGMA database_list") if nome == "main")
+
+
+def file_archivio(conn, anno):
+    """Percorso dell'archivio di un anno, accanto al database principale."""
+    principale = _file_principale(conn)
+    radice = os.path.splitext(os.path.basename(principale))[0]
+    return os.path.join(os.path.dirname(principale), f"{radice}_archivio_{anno}.db")
+
+
+def _archivi(conn, inizio=None, fine=None):
+    """Gli archivi (schema, file, inizio, fine) che si sovrappongono a [inizio, fine), dal più vecchio."""
+    condizioni, parametri = [], []
+    if inizio is not None:
+        condizioni.append("fine > ?")
+        parametri.append(inizio)
+    if fine is not None:
+        condizioni.append("inizio < ?")
+        parametri.append(fine)
+    dove = (" WHERE " + " AND ".join(condizioni)) if condizioni else ""
+    return conn.execute(
+        f"SELECT schema, file, inizio, fine FROM archivi{dove} ORDER BY inizio", parametri
+    ).fetchall()
+
+
+def aggancia(conn, schema, file):
+    """
+    Aggancia l'archivio alla connessione, se manca, e ne restituisce lo
+    schema. Va chiamata fuori dalle transazioni, come ATTACH e DETACH.
+    """
+    agganciati = [nome for _, nome, _ in conn.execute("PRAGMA database_list") if nome.startswith("archivio_")]
+    if schema in agganciati:
+        return schema
+    # database_list segue l'ordine di aggancio. Un archivio con una query
+    # ancora aperta non si può sganciare: si passa al successivo
+    for vecchio in agganciati:
+        if len(agganciati) < MASSIMO_ARCHIVI_AGGANCIATI:
+            break
+        try:
+            conn.execute(f"DETACH DATABASE {vecchio}")
+        except sqlite3.OperationalError:
+            continue
+        agganciati.remove(vecchio)
+    percorso = os.path.join(os.path.dirname(_file_principale(conn)), os.path.basename(file))
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (percorso,))
+    return schema
+
+
+def partizioni(conn, inizio=None, fine=None):
+    """
+    Gli schemi con segnalazioni di [inizio, fine): "main" e poi gli archivi
+    che si sovrappongono al periodo. Ogni archivio si aggancia quando il
+    generatore ci arriva: le query sullo schema precedente devono essere
+    già concluse, perché potrebbe venire sganciato.
+    """
+    yield "main"
+    for schema, file, _, _ in _archivi(conn, inizio, fine):
+        yield aggancia(conn, schema, file)
+
+
+def _unisci(gruppi, decrescente):
+    """Unisce gruppi di righe ordinati per (data, id), scartando gli id ripetuti."""
+    ultimo = None
+    for riga in heapq.merge(*gruppi, key=_chiave_riga, reverse=decrescente):
+        if riga[0] != ultimo:
+            ultimo = riga[0]
+            yield riga
+
+
+def _chiave_riga(riga):
+    # Le colonne sono sempre id, turno, segnalazione, data
+    return (riga[3], riga[0])
+
+
+def righe_partizioni(conn, inizio=None, fine=None, turno=None, decrescente=False, blocco=500):
+    """
+    Generatore sulle segnalazioni di [inizio, fine) in tutte le partizioni,
+    ordinate per (data, id). Legge a blocchi: la memoria non dipende dal
+    numero di righe.
+    """
+    ordine = "DESC" if decrescente else "ASC"
+
+    def scorri(schema, da, a):
+        condizioni, parametri = [], []
+        if da is not None:
+            condizioni.append("data >= ?")
+            parametri.append(da)
+        if a is not None:
+            condizioni.append("data < ?")
+            parametri.append(a)
+        if turno:
+            condizioni.append("turno = ?")
+            parametri.append(turno)
+        dove = (" WHERE " + " AND ".join(condizioni)) if condizioni else ""
+        c = conn.execute(
+            f"SELECT id, turno, segnalazione, data FROM {schema}.segnalazioni{dove} "
+            f"ORDER BY data {ordine}, id {ordine}",
+            parametri,
+        )
+        while True:
+            righe = c.fetchmany(blocco)
+            if not righe:
+                break
+            yield from righe
+
+    # Gli archivi sono di anni diversi, quindi di periodi disgiunti: il
+    # periodo si divide in tratti con al più un archivio, letti in ordine,
+    # e ogni archivio serve solo per il suo tratto
+    tratti, da = [], inizio
+    for schema, file, inizio_archivio, fine_archivio in _archivi(conn, inizio, fine):
+        if da is None or inizio_archivio > da:
+            tratti.append((da, inizio_archivio, None))
+            da = inizio_archivio
+        tratti.append((da, fine_archivio if fine is None else min(fine, fine_archivio), (schema, file)))
+        da = fine_archivio
+    if fine is None or da is None or da < fine:
+        tratti.append((da, fine, None))
+    for da, a, archivio in (reversed(tratti) if decrescente else tratti):
+        if archivio is None:
+            yield from scorri("main", da, a)
+        else:
+            schema = aggancia(conn, *archivio)
+            yield from _unisci([scorri("main", da, a), scorri(schema, da, a)], decrescente)
+
+
+def _crea_archivio(conn, schema):
+    # Ogni archivio ha il suo indice full-text, riempito quando vi si
+    # spostano le righe; gli archivi creati prima dell'indice lo
+    # ricostruiscono qui, una volta sola
+    conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+    senza_indice = conn.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'segnalazioni_fts'"
+    ).fetchone() is None
+    _esegui_script(conn, f'''
+        CREATE TABLE IF NOT EXISTS {schema}.segnalazioni
+            (id INTEGER PRIMARY KEY,
+             turno TEXT NOT NULL,
+             segnalazione TEXT NOT NULL,
+             data INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS {schema}.idx_segnalazioni_data ON segnalazioni (data, id);
+        CREATE INDEX IF NOT EXISTS {schema}.idx_segnalazioni_turno_data ON segnalazioni (turno, data, id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.segnalazioni_fts USING fts5(
+            segnalazione,
+            content='segnalazioni',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3 4 5 6'
+        );
+    ''')
+    if senza_indice:
+        conn.execute(f"INSERT INTO {schema}.segnalazioni_fts (segnalazioni_fts) VALUES ('rebuild')")
+    conn.commit()
+
+
+def aggiorna_archivi(conn):
+    """Aggiunge l'indice full-text agli archivi creati senza."""
+    for schema, file, _, _ in _archivi(conn):
+        aggancia(conn, schema, file)
+        try:
+            if conn.execute(
+                f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'segnalazioni_fts'"
+            ).fetchone() is None:
+                _crea_archivio(conn, schema)
+                print(f"Indice di ricerca creato per {file}")
+        finally:
+            conn.execute(f"DETACH DATABASE {schema}")
+
+
+def archivia_mese(conn, anno, mese):
+    """
+    Sposta le segnalazioni di un mese (ora italiana) nell'archivio del suo
+    anno e restituisce quante erano. Prima le copia e committa l'archivio,
+    poi le cancella dal principale: dopo un'interruzione le righe restano
+    al più in entrambi (le letture scartano i doppioni) e basta ripetere.
+    """
+    schema = f"archivio_{anno}"
+    inizio = a_epoch(datetime(anno, mese, 1))
+    fine = a_epoch(datetime(anno + mese // 12, mese % 12 + 1, 1))
+    aggancia(conn, schema, file_archivio(conn, anno))
+    try:
+        _crea_archivio(conn, schema)
+        spostate = _sposta_mese(conn, schema, anno, inizio, fine)
+    finally:
+        conn.execute(f"DETACH DATABASE {schema}")
+    return spostate
+
+
+def _sposta_mese(conn, schema, anno, inizio, fine):
+    # Due transazioni: copia nell'archivio, poi cancellazione dal principale
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Nell'indice dell'archivio solo le righe che non c'erano già, se
+        # si sta ripetendo un'archiviazione interrotta
+        conn.execute(
+            f"INSERT INTO {schema}.segnalazioni_fts (rowid, segnalazione) "
+            "SELECT id, segnalazione FROM main.segnalazioni m WHERE data >= ? AND data < ? "
+            f"AND NOT EXISTS (SELECT 1 FROM {schema}.segnalazioni a WHERE a.id = m.id)",
+            (inizio, fine),
+        )
+        conn.execute(
+            f"INSERT OR IGNORE INTO {schema}.segnalazioni (id, turno, segnalazione, data) "
+            "SELECT id, turno, segnalazione, data FROM main.segnalazioni WHERE data >= ? AND data < ?",
+            (inizio, fine),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        spostate = conn.execute(
+            "DELETE FROM main.segnalazioni WHERE data >= ? AND data < ?", (inizio, fine)
+        ).rowcount
+        righe = conn.execute(f"SELECT COUNT(*) FROM {schema}.segnalazioni").fetchone()[0]
+        conn.execute(
+            "INSERT INTO archivi (schema, file, inizio, fine, righe) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (schema) DO UPDATE SET inizio = MIN(inizio, excluded.inizio), "
+            "fine = MAX(fine, excluded.fine), righe = excluded.righe",
+            (schema, os.path.basename(file_archivio(conn, anno)), inizio, fine, righe),
+        )
+        _segna_modifica_esterna(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return spostate
+
+
+def archivia(conn, mesi):
+    """
+    Archivia i mesi più vecchi, lasciando nel database principale il mese
+    in corso e i mesi precedenti indicati. Restituisce [(anno, mese, righe)].
+    """
+    adesso = da_epoch(time.time())
+    indice = adesso.year * 12 + adesso.month - 1 - mesi
+    limite = a_epoch(datetime(indice // 12, indice % 12 + 1, 1))
+    archiviati = []
+    while True:
+        piu_vecchia = conn.execute(
+            "SELECT MIN(data) FROM main.segnalazioni WHERE data < ?", (limite,)
+        ).fetchone()[0]
+        if piu_vecchia is None:
+            return archiviati
+        giorno = da_epoch(piu_vecchia)
+        archiviati.append((giorno.year, giorno.month, archivia_mese(conn, giorno.year, giorno.month)))
+
+
+def leggi_pagina(conn, cursore=None, direzione="succ", limite=20):
+    """
+    Paginazione a cursore su (data, id), dalla più recente.
+
+    cursore è la coppia (data, id) dell'ultima riga della pagina precedente
+    (direzione "succ") o della prima riga della pagina successiva
+    (direzione "prec"). Restituisce (righe, ci_sono_più_recenti, ci_sono_più_vecchie).
+    """
+    if cursore is None:
+        righe = _pagina_partizioni(
+            conn, "ORDER BY data DESC, id DESC LIMIT ?", (limite + 1,), None, True, limite
+        )
+        return righe[:limite], False, len(righe) > limite
+    if direzione == "succ":
+        righe = _pagina_partizioni(
+            conn, "WHERE (data, id) < (?, ?) ORDER BY data DESC, id DESC LIMIT ?",
+            (*cursore, limite + 1), cursore, True, limite,
+        )
+        return righe[:limite], True, len(righe) > limite
+    righe = _pagina_partizioni(
+        conn, "WHERE (data, id) > (?, ?) ORDER BY data ASC, id ASC LIMIT ?",
+        (*cursore, limite + 1), cursore, False, limite,
+    )
+    return list(reversed(righe[:limite])), len(righe) > limite, True
+
+
+def _pagina_partizioni(conn, condizione, parametri, cursore, decrescente, limite):
+    # Ogni partizione dà al più limite + 1 righe dall'indice (data, id).
+    # Gli archivi si visitano dal più vicino al cursore e ci si ferma appena
+    # le righe già trovate battono tutte quelle dell'archivio successivo:
+    # di solito la pagina sta tutta nel principale e non se ne aggancia nessuno
+    query = f"SELECT id, turno, segnalazione, data FROM {{}}.segnalazioni {condizione}"
+    righe = conn.execute(query.format("main"), parametri).fetchall()
+    archivi = _archivi(conn)
+    if decrescente:
+        archivi = [a for a in reversed(archivi) if cursore is None or a[2] <= cursore[0]]
+    else:
+        archivi = [a for a in archivi if a[3] > cursore[0]]
+    for schema, file, inizio_archivio, fine_archivio in archivi:
+        if len(righe) > limite:
+            confine = righe[limite][3]
+            if confine >= fine_archivio if decrescente else confine < inizio_archivio:
+                break
+        gruppo = conn.execute(query.format(aggancia(conn, schema, file)), parametri).fetchall()
+        righe = list(itertools.islice(_unisci([righe, gruppo], decrescente), limite + 1))
+    return righe
+
+
+def espressione_fts(termini):
+    """
+    Trasforma le parole dell'utente in una query FTS5 sicura: ogni parola
+    diventa un prefisso tra virgolette, e tutte devono comparire.
+    """
+    parole = [t.replace('"', '') for t in termini]
+    return " ".join(f'"{p}"*' for p in parole if p)
+
+
+# Le corrispondenze si ordinano per pertinenza a finestre di
+# CANDIDATI_RICERCA, dalle ultime registrate. Il bm25 su tutte le
+# corrispondenze di una parola frequente costerebbe centinaia di ms su un
+# milione di righe, mentre FTS5 scorre i risultati per rowid decrescente e
+# si ferma al limite. Finita una finestra si prosegue con la successiva,
+# fatta delle corrispondenze con id sotto la soglia: nessuna resta
+# irraggiungibile. Gli archivi hanno ciascuno il proprio indice: ogni
+# partizione dà le sue corrispondenze più recenti, e i punteggi bm25, che
+# dipendono dalle statistiche del proprio indice, si confrontano come sono
+CANDIDATI_RICERCA = 500
+
+
+def prossimo_id(conn):
+    """Il primo id non ancora assegnato: le righe inserite dopo hanno id maggiori."""
+    riga = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'segnalazioni'").fetchone()
+    return (riga[0] if riga else 0) + 1
+
+
+def finestra_ricerca(conn, espressione, turno=None, inizio=None, fine=None, soglia=None):
+    """
+    Le CANDIDATI_RICERCA corrispondenze più recenti con id sotto soglia,
+    ordinate per (punteggio, id). Restituisce (righe, soglia della finestra
+    successiva), con None se non ci sono altre corrispondenze.
+    """
+    query = (
+        "SELECT s.*, f.rank AS punteggio FROM {schema}.segnalazioni_fts f "
+        "JOIN {schema}.segnalazioni s ON s.id = f.rowid WHERE segnalazioni_fts MATCH ?"
+    )
+    parametri = [espressione]
+    if soglia is not None:
+        query += " AND f.rowid < ?"
+        parametri.append(soglia)
+    if turno:
+        query += " AND s.turno = ?"
+        parametri.append(turno)
+    if inizio is not None:
+        query += " AND s.data >= ?"
+        parametri.append(inizio)
+    if fine is not None:
+        query += " AND s.data < ?"
+        parametri.append(fine)
+    query += " ORDER BY f.rowid DESC LIMIT ?"
+    parametri.append(CANDIDATI_RICERCA + 1)
+    righe = {}
+    for schema in partizioni(conn, inizio, fine):
+        # Durante un'archiviazione una riga può stare in due partizioni
+        for riga in conn.execute(query.format(schema=schema), parametri):
+            righe[riga["id"]] = riga
+    righe = heapq.nlargest(CANDIDATI_RICERCA + 1, righe.values(), key=lambda r: r["id"])
+    successiva = righe[CANDIDATI_RICERCA - 1]["id"] if len(righe) > CANDIDATI_RICERCA else None
+    return sorted(righe[:CANDIDATI_RICERCA], key=lambda r: (r["punteggio"], r["id"])), successiva
+
+
+def cerca_segnalazioni(conn, espressione, turno=None, inizio=None, fine=None, soglia=None,
+                       cursore=None, direzione="succ", limite=20):
+    """
+    Ricerca full-text ordinata per pertinenza (bm25) nella finestra sotto
+    soglia, con la stessa paginazione a cursore di leggi_pagina: qui il
+    cursore è (punteggio, id). Restituisce (righe, ci_sono_più_pertinenti,
+    ci_sono_meno_pertinenti, soglia della finestra successiva).
+    """
+    finestra, successiva = finestra_ricerca(conn, espressione, turno, inizio, fine, soglia)
+    chiavi = [(r["punteggio"], r["id"]) for r in finestra]
+    if direzione == "succ":
+        primo = 0 if cursore is None else bisect.bisect_right(chiavi, tuple(cursore))
+        ultimo = min(len(finestra), primo + limite)
+    else:
+        ultimo = len(finestra) if cursore is None else bisect.bisect_left(chiavi, tuple(cursore))
+        primo = max(0, ultimo - limite)
+    return finestra[primo:ultimo], primo > 0, ultimo < len(finestra), successiva
@@ -0,0 +1,164 @@
+import asyncio
+import time
+
+from metriche import attesa_coda, registro
+
+
+class TokenBucket:
+    """Secchiello di gettoni: capacita gettoni, ricaricati a velocità costante."""
+
+    def __init__(self, capacita, ricarica_al_secondo):
+        self.capacita = capacita
+        self.ricarica_al_secondo = ricarica_al_secondo
+        self.gettoni = float(capacita)
+        self.ultimo = time.monotonic()
+
+    def _ricarica(self):
+        adesso = time.monotonic()
+        self.gettoni = min(
+            self.capacita, self.gettoni + (adesso - self.ultimo) * self.ricarica_al_secondo
+        )
+        self.ultimo = adesso
+
+    def attesa(self):
+        """Secondi da aspettare prima che ci sia un gettone (0 se c'è già)."""
+        self._ricarica()
+        if self.gettoni >= 1:
+            return 0.0
+        return (1 - self.gettoni) / self.ricarica_al_secondo
+
+    def preleva(self):
+        self._ricarica()
+        self.gettoni -= 1
+
+    def pieno(self):
+        self._ricarica()
+        return self.gettoni >= self.capacita
+
+
+class Ingestione:
+    """
+    Stadio d'ingresso delle segnalazioni, davanti al salvataggio.
+
+    Ogni chat ha un token bucket: un gettone per ogni conferma inviata.
+    Finché la chat ha gettoni, ogni messaggio viene salvato e confermato
+    subito; durante una raffica i messaggi si accumulano e vengono salvati
+    insieme, con un'unica conferma, appena torna un gettone. I messaggi in
+    attesa sono limitati sia per chat sia in totale: oltre il limite
+    vengono scartati esplicitamente e la chat viene avvisata.
+    """
+
+    def __init__(self, salva, avvisa_scarto, capacita=3, ricarica_al_secondo=1 / 3,
+                 massimo_in_coda=5000, massimo_per_chat=500, intervallo_avvisi=60):
+        # salva(messaggi) riceve una lista di (messaggio, istante di arrivo);
+        # avvisa_scarto(messaggio) notifica la chat di un messaggio perso
+        self.salva = salva
+        self.avvisa_scarto = avvisa_scarto
+        self.capacita = capacita
+        self.ricarica_al_secondo = ricarica_al_secondo
+        self.massimo_in_coda = massimo_in_coda
+        self.massimo_per_chat = massimo_per_chat
+        self.intervallo_avvisi = intervallo_avvisi
+        self._secchielli = {}
+        self._soglia_pulizia = 10000
+        self._in_attesa = {}
+        self._task = {}
+        self._ultimi_avvisi = {}
+        self.in_coda = 0
+        self.accodati = 0
+        self.scartati = 0
+        self.raggruppati = 0
+        self.salvataggi = 0
+
+    def metriche(self):
+        return {
+            'in_coda': self.in_coda,
+            'accodati': self.accodati,
+            'scartati': self.scartati,
+            'raggruppati': self.raggruppati,
+            'salvataggi': self.salvataggi,
+        }
+
+    async def accoda(self, chat_id, messaggio):
+        """Accetta un messaggio o lo scarta se le code sono piene."""
+        in_attesa = len(self._in_attesa.get(chat_id, ()))
+        if self.in_coda >= self.massimo_in_coda or in_attesa >= self.massimo_per_chat:
+            self.scartati += 1
+            await self._avvisa(chat_id, messaggio)
+            return False
+
+        self._in_attesa.setdefault(chat_id, []).append((messaggio, time.time()))
+        self.in_coda += 1
+        self.accodati += 1
+        if chat_id not in self._task:
+            self._task[chat_id] = asyncio.create_task(self._svuota(chat_id))
+        return True
+
+    async def _avvisa(self, chat_id, messaggio):
+        # Un solo avviso per chat per intervallo, per non aggravare la raffica
+        adesso = time.monotonic()
+        if adesso - self._ultimi_avvisi.get(chat_id, -self.intervallo_avvisi) < self.intervallo_avvisi:
+            return
+        self._ultimi_avvisi[chat_id] = adesso
+        try:
+            await self.avvisa_scarto(messaggio)
+        except Exception as e:
+            print(f"Errore nell'avviso di scarto alla chat {chat_id}: {e}")
+
+    def _secchiello(self, chat_id):
+        secchiello = self._secchielli.get(chat_id)
+        if secchiello is None:
+            if len(self._secchielli) > self._soglia_pulizia:
+                # I secchielli pieni equivalgono a quelli nuovi: si possono buttare.
+                # La soglia segue quelli rimasti, così la pulizia resta ammortizzata
+                for chiave in [c for c, s in self._secchielli.items() if s.pieno()]:
+                    del self._secchielli[chiave]
+                self._soglia_pulizia = max(10000, 2 * len(self._secchielli))
+            secchiello = TokenBucket(self.capacita, self.ricarica_al_secondo)
+            self._secchielli[chat_id] = secchiello
+        return secchiello
+
+    async def _svuota(self, chat_id):
+        secchiello = self._secchiello(chat_id)
+        try:
+            while self._in_attesa.get(chat_id):
+                attesa = secchiello.attesa()
+                if attesa:
+                    # Intanto i messaggi della raffica si accumulano
+                    await asyncio.sleep(attesa)
+                secchiello.preleva()
+                lotto = self._in_attesa.pop(chat_id)
+                self.in_coda -= len(lotto)
+                if len(lotto) > 1:
+                    self.raggruppati += len(lotto)
+                self.salvataggi += 1
+                if registro.attivo:
+                    adesso = time.time()
+                    for _, arrivo in lotto:
+                        attesa_coda.osserva(adesso - arrivo)
+                try:
+                    await self.salva(lotto)
+                except Exception as e:
+                    print(f"Errore nel salvataggio delle segnalazioni della chat {chat_id}: {e}")
+        finally:
+            del self._task[chat_id]
+
+    async def chiudi(self):
+        """Attende che le segnalazioni già accettate siano salvate."""
+        while self._task:
+            await asyncio.gather(*list(self._task.values()), return_exceptions=True)
+
+
+def metriche_prometheus(ingestione):
+    """Raccolta per metriche.registro con i contatori dell'ingestione."""
+    descrizioni = {
+        'in_coda': ("gauge", "Segnalazioni in attesa di salvataggio"),
+        'accodati': ("counter", "Segnalazioni accettate dall'ingestione"),
+        'scartati': ("counter", "Segnalazioni scartate per code piene"),
+        'raggruppati': ("counter", "Segnalazioni salvate insieme ad altre della stessa raffica"),
+        'salvataggi': ("counter", "Salvataggi eseguiti, uno per conferma inviata"),
+    }
+    return [
+        (f"vigilbot_ingestione_{nome}", *descrizioni[nome], valore)
+        for nome, valore in ingestione.metriche().items()
+    ]
@@ -0,0 +1,145 @@
+import functools
+import time
+from bisect import bisect_left
+
+# Limiti superiori dei bucket di latenza, in secondi
+BUCKET_LATENZA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _etichette(chiave):
+    if not chiave:
+        return ""
+    return "{" + ",".join(f'{nome}="{valore}"' for nome, valore in chiave) + "}"
+
+
+class Contatore:
+    def __init__(self, nome, descrizione):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.valori = {}
+
+    def incrementa(self, quanto=1, **etichette):
+        chiave = tuple(sorted(etichette.items()))
+        self.valori[chiave] = self.valori.get(chiave, 0) + quanto
+
+    def esporta(self):
+        righe = [f"# HELP {self.nome} {self.descrizione}", f"# TYPE {self.nome} counter"]
+        righe += [f"{self.nome}{_etichette(k)} {v}" for k, v in self.valori.items()]
+        return righe
+
+
+class Istogramma:
+    """
+    Istogramma cumulativo nel formato Prometheus: le finestre mobili
+    (latenza degli ultimi N minuti) si ricavano lato Prometheus con rate().
+    """
+
+    def __init__(self, nome, descrizione, bucket=BUCKET_LATENZA):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.bucket = bucket
+        # chiave delle etichette -> [conteggi per bucket (+Inf in coda), somma]
+        self.serie = {}
+
+    def osserva(self, valore, **etichette):
+        chiave = tuple(sorted(etichette.items()))
+        serie = self.serie.get(chiave)
+        if serie is None:
+            serie = self.serie[chiave] = [[0] * (len(self.bucket) + 1), 0.0]
+        serie[0][bisect_left(self.bucket, valore)] += 1
+        serie[1] += valore
+
+    def esporta(self):
+        righe = [f"# HELP {self.nome} {self.descrizione}", f"# TYPE {self.nome} histogram"]
+        for chiave, (conteggi, somma) in self.serie.items():
+            cumulato = 0
+            for limite, conteggio in zip((*self.bucket, "+Inf"), conteggi):
+                cumulato += conteggio
+                righe.append(f"{self.nome}_bucket{_etichette(chiave + (('le', limite),))} {cumulato}")
+            righe.append(f"{self.nome}_sum{_etichette(chiave)} {somma}")
+            righe.append(f"{self.nome}_count{_etichette(chiave)} {cumulato}")
+        return righe
+
+
+class Registro:
+    """
+    Metriche del processo. Tutte le misure vengono registrate dal thread
+    dell'event loop, quindi non servono lock.
+    """
+
+    def __init__(self):
+        self.attivo = True
+        self._metriche = []
+        self._raccolte = []
+        self.avvio = time.time()
+
+    def contatore(self, nome, descrizione):
+        metrica = Contatore(nome, descrizione)
+        self._metriche.append(metrica)
+        return metrica
+
+    def istogramma(self, nome, descrizione, bucket=BUCKET_LATENZA):
+        metrica = Istogramma(nome, descrizione, bucket)
+        self._metriche.append(metrica)
+        return metrica
+
+    def raccolta(self, funzione):
+        """
+        Registra una funzione letta a ogni esportazione, per i valori che
+        vivono altrove: restituisce [(nome, tipo, descrizione, valore)].
+        """
+        self._raccolte.append(funzione)
+        return funzione
+
+    def esporta(self):
+        righe = []
+        for metrica in self._metriche:
+            righe += metrica.esporta()
+        for funzione in self._raccolte:
+            for nome, tipo, descrizione, valore in funzione():
+                righe += [f"# HELP {nome} {descrizione}", f"# TYPE {nome} {tipo}", f"{nome} {valore}"]
+        return "\n".join(righe) + "\n"
+
+
+registro = Registro()
+
+update_totali = registro.contatore("vigilbot_update_totali", "Update gestiti dagli handler")
+errori_totali = registro.contatore("vigilbot_errori_totali", "Eccezioni sollevate dagli handler")
+durata_handler = registro.istogramma("vigilbot_handler_secondi", "Durata degli handler")
+durata_db = registro.istogramma("vigilbot_db_secondi", "Durata delle operazioni sul database, attesa del pool inclusa")
+righe_scritte = registro.contatore("vigilbot_righe_scritte_totali", "Segnalazioni committate")
+durata_report = registro.istogramma("vigilbot_report_secondi", "Durata della generazione dei report PDF")
+cache_richieste = registro.contatore("vigilbot_cache_richieste_totali", "Letture dalle cache delle risposte, per esito")
+attesa_coda = registro.istogramma("vigilbot_attesa_coda_secondi", "Attesa delle segnalazioni nella coda di ingestione")
+
+
+registro.raccolta(lambda: [(
+    "vigilbot_uptime_secondi", "gauge", "Secondi dall'avvio del processo",
+    round(time.time() - registro.avvio, 3),
+)])
+
+
+def strumenta(nome, callback):
+    """Avvolge un handler per misurarne durata, numero di update ed errori."""
+    @functools.wraps(callback)
+    async def misurato(update, context):
+        if not registro.attivo:
+            return await callback(update, context)
+        inizio = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            errori_totali.incrementa(handler=nome)
+            raise
+        finally:
+            durata_handler.osserva(time.perf_counter() - inizio, handler=nome)
+            update_totali.incrementa(handler=nome)
+    return misurato
+
+
+def strumenta_applicazione(application):
+    """Strumenta tutti gli handler già registrati nell'applicazione."""
+    for gruppo in application.handlers.values():
+        for handler in gruppo:
+            nome = getattr(handler.callback, "__name__", type(handler).__name__)
+            handler.callback = strumenta(nome, handler.callback)
@@ -0,0 +1,67 @@
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+# Regola europea: l'ora legale va dall'ultima domenica di marzo
+# all'ultima domenica di ottobre, con il cambio alle 01:00 UTC
+ORA_SOLARE = timezone(timedelta(hours=1))
+ORA_LEGALE = timezone(timedelta(hours=2))
+
+
+def _ultima_domenica(anno, mese):
+    giorno = datetime(anno, mese, 31, 1, tzinfo=timezone.utc)
+    return giorno - timedelta(days=(giorno.weekday() + 1) % 7)
+
+
+@lru_cache(maxsize=None)
+def transizioni(anno):
+    """Epoch UTC di inizio e fine dell'ora legale nell'anno, calcolati una volta."""
+    return (
+        int(_ultima_domenica(anno, 3).timestamp()),
+        int(_ultima_domenica(anno, 10).timestamp()),
+    )
+
+
+def offset_epoch(epoch):
+    """Ore di offset da UTC (1 o 2) all'istante epoch."""
+    inizio, fine = transizioni(time.gmtime(epoch).tm_year)
+    return 2 if inizio <= epoch < fine else 1
+
+
+def prossimo_cambio_ora(epoch):
+    """Epoch UTC del primo cambio d'ora successivo all'istante."""
+    anno = time.gmtime(epoch).tm_year
+    for cambio in (*transizioni(anno), transizioni(anno + 1)[0]):
+        if cambio > epoch:
+            return cambio
+
+
+def is_ora_legale(istante):
+    """True se l'istante (datetime aware) cade nell'ora legale italiana."""
+    return offset_epoch(istante.timestamp()) == 2
+
+
+def tz_italia(istante):
+    return ORA_LEGALE if is_ora_legale(istante) else ORA_SOLARE
+
+
+def da_epoch(epoch):
+    """Converte un epoch UTC in datetime con l'offset italiano corretto."""
+    fuso = ORA_LEGALE if offset_epoch(epoch) == 2 else ORA_SOLARE
+    return datetime.fromtimestamp(epoch, fuso)
+
+
+def ora_italia():
+    return da_epoch(time.time())
+
+
+def a_epoch(locale):
+    """
+    Converte un datetime naive in ora italiana in epoch UTC. Nell'ora
+    ripetuta di ottobre vale l'ora legale, nell'ora saltata di marzo
+    si scivola in avanti di un'ora.
+    """
+    legale = locale.replace(tzinfo=ORA_LEGALE)
+    if is_ora_legale(legale):
+        return int(legale.timestamp())
+    return int(locale.replace(tzinfo=ORA_SOLARE).timestamp())
@@ -0,0 +1,86 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class Profilatore:
+    """
+    Profilatore a campionamento, attivabile a caldo.
+
+    Un thread separato legge lo stack del thread osservato (l'event loop)
+    a intervalli regolari e conta quante volte compare ogni stack. Da
+    spento non costa nulla; da acceso costa un campione ogni intervallo.
+    """
+
+    def __init__(self, intervallo=0.005):
+        self.intervallo = intervallo
+        self._thread = None
+        self._fermo = threading.Event()
+        self._stack = Counter()
+        self.campioni = 0
+        self.avviato = None
+
+    @property
+    def attivo(self):
+        return self._thread is not None
+
+    def avvia(self, thread_id=None):
+        if self.attivo:
+            return False
+        self._stack = Counter()
+        self.campioni = 0
+        self.avviato = time.time()
+        self._fermo.clear()
+        self._thread = threading.Thread(
+            target=self._campiona,
+            args=(thread_id or threading.get_ident(),),
+            name="profilatore",
+            daemon=True,
+        )
+        self._thread.start()
+        return True
+
+    def ferma(self):
+        if not self.attivo:
+            return False
+        self._fermo.set()
+        self._thread.join()
+        self._thread = None
+        return True
+
+    def _campiona(self, thread_id):
+        while not self._fermo.wait(self.intervallo):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                codice = frame.f_code
+                stack.append(f"{codice.co_name} ({os.path.basename(codice.co_filename)}:{codice.co_firstlineno})")
+                frame = frame.f_back
+            self._stack[tuple(reversed(stack))] += 1
+            self.campioni += 1
+
+    def riepilogo(self, quante=15):
+        """Le funzioni con più campioni, proprie (in cima allo stack) e totali."""
+        if not self.campioni:
+            return "Nessun campione raccolto."
+        proprie, totali = Counter(), Counter()
+        for stack, conteggio in self._stack.items():
+            proprie[stack[-1]] += conteggio
+            for funzione in set(stack):
+                totali[funzione] += conteggio
+        durata = (time.time() - self.avviato) if self.avviato else 0
+        righe = [f"{self.campioni} campioni in {durata:.0f} s", "", "Tempo proprio:"]
+        righe += [f"{c * 100 / self.campioni:5.1f}% {f}" for f, c in proprie.most_common(quante)]
+        righe += ["", "Tempo totale:"]
+        righe += [f"{c * 100 / self.campioni:5.1f}% {f}" for f, c in totali.most_common(quante)]
+        return "\n".join(righe)
+
+    def collassato(self):
+        """Stack in formato collassato, leggibile da flamegraph.pl e speedscope."""
+        return "\n".join(
+            f"{';'.join(stack)} {conteggio}" for stack, conteggio in self._stack.most_common()
+        ) + "\n"
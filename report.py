@@ -0,0 +1,358 @@
+import asyncio
+import glob
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from fpdf import FPDF
+
+from database import partizioni, righe_partizioni
+from metriche import durata_report
+from orario import a_epoch, da_epoch
+
+# Cartella delle pagine già renderizzate per i giorni chiusi
+CACHE_REPORT_PREDEFINITA = "cache_report"
+
+# Righe lette per volta dal cursore: nessun processo tiene in memoria la tabella
+RIGHE_PER_BLOCCO = 500
+
+
+class _Buffer:
+    """
+    Sostituisce la stringa FPDF.buffer: FPDF 1.7.2 ci concatena ogni riga
+    del documento con +=, un costo quadratico oltre qualche MB.
+    """
+
+    def __init__(self):
+        self._parti = []
+        self._lunghezza = 0
+
+    def __iadd__(self, testo):
+        self._parti.append(testo)
+        self._lunghezza += len(testo)
+        return self
+
+    def __len__(self):
+        return self._lunghezza
+
+    def encode(self, codifica):
+        return "".join(self._parti).encode(codifica)
+
+
+class _PDF(FPDF):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer = _Buffer()
+
+
+def _nuovo_pdf():
+    pdf = _PDF()
+    pdf.set_auto_page_break(True, 15)
+    # I content stream delle pagine riferiscono i font per indice (/F1, /F2):
+    # registrandoli sempre nello stesso ordine, le pagine in cache restano
+    # valide in qualunque documento vengano incollate
+    pdf.set_font("Arial", "B", 12)
+    pdf.set_font("Arial", size=10)
+    return pdf
+
+
+def _latin1(testo):
+    # I font core di FPDF supportano solo latin-1 (niente emoji)
+    return testo.encode("latin-1", "replace").decode("latin-1")
+
+
+def _righe(path_db, inizio, fine, turno):
+    """Generatore sulle segnalazioni di [inizio, fine), dalla più recente, archivi compresi."""
+    conn = sqlite3.connect(f"file:{path_db}?mode=ro", uri=True)
+    try:
+        yield from righe_partizioni(
+            conn, inizio, fine, turno, decrescente=True, blocco=RIGHE_PER_BLOCCO
+        )
+    finally:
+        conn.close()
+
+
+def renderizza_giorno(path_db, giorno, turno, path_uscita):
+    """
+    Eseguita nel process pool: rende le segnalazioni di un giorno (ora
+    italiana) e salva in path_uscita i content stream delle pagine.
+    """
+    inizio, fine = limiti_giorno(giorno)
+    pdf = _nuovo_pdf()
+    pdf.add_page()
+    pdf.set_font("Arial", "B", 13)
+    titolo = giorno.strftime("%d/%m/%Y") + (f" - Turno {turno}" if turno else "")
+    pdf.cell(0, 9, titolo, ln=True)
+    pdf.ln(2)
+
+    for _, turno_riga, segnalazione, data in _righe(path_db, inizio, fine, turno):
+        pdf.set_font("Arial", "B", 11)
+        pdf.cell(0, 7, f"Turno {turno_riga} - {da_epoch(data).strftime('%Y-%m-%d %H:%M:%S')}", ln=True)
+        pdf.set_font("Arial", size=10)
+        pdf.multi_cell(0, 7, _latin1(segnalazione))
+        pdf.ln(5)
+
+    pagine = [pdf.pages[n] for n in range(1, pdf.page + 1)]
+    fd, temporaneo = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path_uscita))
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(pagine, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporaneo, path_uscita)
+    return path_uscita
+
+
+def componi_report(intestazione, titolo_elenco, file_giorni, path_uscita):
+    """Eseguita nel process pool: unisce le pagine dei giorni in un unico PDF."""
+    pdf = _nuovo_pdf()
+    pdf.add_page()
+    pdf.set_font("Arial", "B", 16)
+    pdf.cell(0, 10, "Registro Segnalazioni", ln=True, align='C')
+    pdf.set_font("Arial", size=12)
+    for riga in intestazione:
+        pdf.cell(0, 10, riga, ln=True, align='L')
+    pdf.ln(10)
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(0, 10, titolo_elenco, ln=True)
+
+    for path in file_giorni:
+        with open(path, "rb") as f:
+            pagine = pickle.load(f)
+        for contenuto in pagine:
+            pdf.add_page()
+            pdf.pages[pdf.page] = contenuto
+
+    pdf.output(path_uscita)
+    return path_uscita
+
+
+def limiti_giorno(giorno):
+    """Estremi [inizio, fine) in epoch del giorno di calendario italiano."""
+    mezzanotte = datetime(giorno.year, giorno.month, giorno.day)
+    return a_epoch(mezzanotte), a_epoch(mezzanotte + timedelta(days=1))
+
+
+def _statistiche_giorno(conn, inizio, fine, turno):
+    query = "SELECT COUNT(*), MAX(id) FROM {}.segnalazioni WHERE data >= ? AND data < ?"
+    parametri = [inizio, fine]
+    if turno:
+        query += " AND turno = ?"
+        parametri.append(turno)
+    conteggio, max_id = 0, None
+    for schema in partizioni(conn, inizio, fine):
+        parziale, massimo = conn.execute(query.format(schema), parametri).fetchone()
+        conteggio += parziale
+        if massimo is not None and (max_id is None or massimo > max_id):
+            max_id = massimo
+    return conteggio, max_id
+
+
+def pianifica_giorni(conn, dal, al, turno):
+    """
+    Restituisce [(giorno, conteggio, max_id)] per i giorni con segnalazioni
+    nel periodo, dal più recente. Usa solo l'indice su (data, id).
+    """
+    inizio = a_epoch(datetime(dal.year, dal.month, dal.day)) if dal else None
+    fine = limiti_giorno(al)[1] if al else None
+    estremi = [
+        conn.execute(
+            f"SELECT MIN(data), MAX(data) FROM {schema}.segnalazioni WHERE data >= ? AND data < ?",
+            (inizio if inizio is not None else -2**63, fine if fine is not None else 2**63 - 1),
+        ).fetchone()
+        for schema in partizioni(conn, inizio, fine)
+    ]
+    estremi = [e for e in estremi if e[0] is not None]
+    if not estremi:
+        return []
+    giorno = da_epoch(max(e[1] for e in estremi)).date()
+    primo = da_epoch(min(e[0] for e in estremi)).date()
+    giorni = []
+    while giorno >= primo:
+        conteggio, max_id = _statistiche_giorno(conn, *limiti_giorno(giorno), turno)
+        if conteggio:
+            giorni.append((giorno, conteggio, max_id))
+        giorno -= timedelta(days=1)
+    return giorni
+
+
+class MotoreReport:
+    """
+    Genera i report PDF fuori dall'event loop.
+
+    Ogni giorno viene reso separatamente in un process pool. I giorni già
+    conclusi sono immutabili: le loro pagine restano in cache su disco,
+    indicizzate da (giorno, turno, conteggio, max id), e vengono solo
+    ricomposte. Il giorno in corso viene sempre rigenerato. Richieste
+    identiche concorrenti condividono lo stesso rendering.
+    """
+
+    def __init__(self, db, cartella_cache=None, processi=None):
+        self.db = db
+        self.cartella_cache = cartella_cache or os.getenv("CACHE_REPORT", CACHE_REPORT_PREDEFINITA)
+        self.processi = processi or min(4, os.cpu_count() or 1)
+        self._pool = None
+        # chiave dei filtri -> [task, utenti in attesa]
+        self._in_corso = {}
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn: i worker non ereditano i thread e i lock del processo del bot
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processi, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def chiudi(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def _file_cache(self, giorno, turno, conteggio, max_id):
+        prefisso = f"{giorno.isoformat()}_{turno or 'tutti'}"
+        return prefisso, os.path.join(self.cartella_cache, f"{prefisso}_{conteggio}_{max_id}.pkl")
+
+    async def _renderizza(self, dal, al, turno):
+        inizio = time.perf_counter()
+        try:
+            return await self._renderizza_giorni(dal, al, turno)
+        finally:
+            durata_report.osserva(
+                time.perf_counter() - inizio, filtrato="si" if dal or al or turno else "no"
+            )
+
+    async def _renderizza_giorni(self, dal, al, turno):
+        os.makedirs(self.cartella_cache, exist_ok=True)
+        giorni = await self.db.leggi(pianifica_giorni, dal, al, turno)
+        totale = sum(conteggio for _, conteggio, _ in giorni)
+        oggi = da_epoch(datetime.now().timestamp()).date()
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+
+        file_giorni, temporanei, lavori = [], [], []
+        for giorno, conteggio, max_id in giorni:
+            if giorno >= oggi:
+                # Giorno aperto: sempre rigenerato, mai messo in cache
+                fd, path = tempfile.mkstemp(suffix=".pkl", dir=self.cartella_cache)
+                os.close(fd)
+                temporanei.append(path)
+            else:
+                prefisso, path = self._file_cache(giorno, turno, conteggio, max_id)
+                if os.path.exists(path):
+                    file_giorni.append(path)
+                    continue
+                # Le versioni precedenti dello stesso giorno non servono più
+                for vecchio in glob.glob(os.path.join(self.cartella_cache, prefisso + "_*.pkl")):
+                    if vecchio != path:
+                        _rimuovi(vecchio)
+            file_giorni.append(path)
+            lavori.append(loop.run_in_executor(
+                pool, renderizza_giorno, self.db.path, giorno, turno, path
+            ))
+
+        try:
+            await asyncio.gather(*lavori)
+            intestazione = [f"Generato il: {da_epoch(datetime.now().timestamp()).strftime('%d/%m/%Y %H:%M:%S')}"]
+            if dal or al or turno:
+                intestazione.append(descrivi_filtri(dal, al, turno))
+                titolo_elenco = f"Elenco Segnalazioni (Totale: {totale})"
+            else:
+                titolo_elenco = f"Elenco Completo Segnalazioni (Totale: {totale})"
+            fd, path_pdf = tempfile.mkstemp(prefix="segnalazioni_", suffix=".pdf")
+            os.close(fd)
+            await loop.run_in_executor(
+                pool, componi_report, intestazione, titolo_elenco, file_giorni, path_pdf
+            )
+        except BrokenProcessPool:
+            # Un worker è morto (es. OOM): il prossimo report ricrea il pool
+            self._pool = None
+            raise
+        finally:
+            for path in temporanei:
+                _rimuovi(path)
+        return path_pdf, totale
+
+    @asynccontextmanager
+    async def report(self, dal=None, al=None, turno=None):
+        """
+        Restituisce (path del PDF, totale righe). Il file viene cancellato
+        quando l'ultimo utente che lo condivide esce dal contesto.
+        """
+        chiave = (dal, al, turno)
+        voce = self._in_corso.get(chiave)
+        if voce is None:
+            voce = [asyncio.create_task(self._renderizza(dal, al, turno)), 0]
+            self._in_corso[chiave] = voce
+        voce[1] += 1
+        try:
+            risultato = await asyncio.shield(voce[0])
+            yield risultato
+        finally:
+            voce[1] -= 1
+            if voce[1] == 0:
+                if self._in_corso.get(chiave) is voce:
+                    del self._in_corso[chiave]
+                # Se tutti hanno rinunciato prima della fine, il file si
+                # cancella quando il rendering termina
+                voce[0].add_done_callback(_rimuovi_risultato)
+
+
+def _rimuovi(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _rimuovi_risultato(task):
+    if not task.cancelled() and task.exception() is None:
+        _rimuovi(task.result()[0])
+
+
+def descrivi_filtri(dal, al, turno):
+    parti = []
+    if dal and al and dal == al:
+        parti.append(f"giorno {dal.strftime('%d/%m/%Y')}")
+    else:
+        if dal:
+            parti.append(f"dal {dal.strftime('%d/%m/%Y')}")
+        if al:
+            parti.append(f"al {al.strftime('%d/%m/%Y')}")
+    if turno:
+        parti.append(f"turno {turno}")
+    return "Filtri: " + ", ".join(parti)
+
+
+def separa_filtri(argomenti):
+    """
+    Separa dagli argomenti di un comando i filtri: fino a due date
+    GG/MM/AAAA (una sola data = quel giorno) e una lettera di turno, in
+    qualsiasi ordine. Restituisce (dal, al, turno, altri argomenti).
+    """
+    date, turno, altri = [], None, []
+    for argomento in argomenti:
+        if argomento.upper() in ("A", "B", "C", "D"):
+            turno = argomento.upper()
+            continue
+        try:
+            date.append(datetime.strptime(argomento, "%d/%m/%Y").date())
+        except ValueError:
+            altri.append(argomento)
+    date.sort()
+    dal = date[0] if date else None
+    al = date[-1] if date else None
+    if len(date) > 2:
+        raise ValueError("indica al massimo due date")
+    return dal, al, turno, altri
+
+
+def leggi_filtri(argomenti):
+    """Filtri di /genera_PDF: ogni argomento deve essere una data o un turno."""
+    dal, al, turno, altri = separa_filtri(argomenti)
+    if altri:
+        raise ValueError(f"argomento non valido: {altri[0]}")
+    return dal, al, turno
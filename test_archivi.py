@@ -0,0 +1,190 @@
+import io
+import time
+from datetime import date
+
+import pytest
+
+import bot
+from database import (
+    MASSIMO_ARCHIVI_AGGANCIATI, aggancia, aggiorna_archivi, apri_connessione, archivia,
+    archivia_mese, cerca_segnalazioni, conta_arretrati_statistiche, conta_segnalazioni,
+    espressione_fts, importa_righe, leggi_pagina, migra, ricostruisci_statistiche, righe_partizioni,
+)
+from report import pianifica_giorni
+from trasferimento import completa_indice, esporta
+
+ANNI = 16
+PASSO = 7 * 3600
+
+
+@pytest.fixture(scope="module")
+def archiviato(tmp_path_factory):
+    """Sedici anni di registro importato, con tutto tranne gli ultimi sei mesi archiviato."""
+    conn = apri_connessione(str(tmp_path_factory.mktemp("archivi") / "segnalazioni.db"))
+    conn.execute("PRAGMA synchronous=OFF")
+    migra(conn)
+    adesso = int(time.time())
+    quante = ANNI * 365 * 86400 // PASSO
+    righe = [
+        ("ABCD"[i % 4], f"riga {i}" + (" idrante" if i % 20 == 0 else ""), adesso - (quante - i) * PASSO)
+        for i in range(quante)
+    ]
+    primo = importa_righe(conn, righe)
+    completa_indice(conn)
+    attese = sorted(
+        ((data, primo + i) for i, (_, _, data) in enumerate(righe)), reverse=True
+    )
+    mesi = archivia(conn, 6)
+    yield conn, attese, mesi
+    conn.close()
+
+
+def archivi_agganciati(conn):
+    return [nome for _, nome, _ in conn.execute("PRAGMA database_list") if nome.startswith("archivio_")]
+
+
+def test_archivia_oltre_dieci_anni(archiviato):
+    conn, attese, mesi = archiviato
+    assert conn.execute("SELECT COUNT(*) FROM archivi").fetchone()[0] > 10
+    assert sum(m[2] for m in mesi) == len(attese) - conn.execute("SELECT COUNT(*) FROM main.segnalazioni").fetchone()[0]
+    assert conta_segnalazioni(conn) == len(attese)
+    assert archivi_agganciati(conn) == []
+
+
+def test_pagine_avanti_e_indietro(archiviato):
+    conn, attese, _ = archiviato
+    letti, cursore, pagine = [], None, []
+    while True:
+        righe, _, altre = leggi_pagina(conn, cursore, "succ", 500)
+        letti += [(r["data"], r["id"]) for r in righe]
+        pagine.append(righe)
+        if not altre:
+            break
+        cursore = (righe[-1]["data"], righe[-1]["id"])
+        assert len(archivi_agganciati(conn)) <= MASSIMO_ARCHIVI_AGGANCIATI
+    assert letti == attese
+
+    # All'indietro dall'ultima pagina si ritrovano le stesse pagine
+    for precedente, pagina in zip(pagine, pagine[1:]):
+        righe, _, _ = leggi_pagina(conn, (pagina[0]["data"], pagina[0]["id"]), "prec", 500)
+        assert [r["id"] for r in righe] == [r["id"] for r in precedente]
+
+
+def test_prima_pagina_senza_archivi(tmp_path):
+    conn = apri_connessione(str(tmp_path / "segnalazioni.db"))
+    migra(conn)
+    adesso = int(time.time())
+    importa_righe(conn, [("A", f"vecchia {i}", adesso - 400 * 86400 + i) for i in range(50)])
+    importa_righe(conn, [("B", f"nuova {i}", adesso - i) for i in range(50)])
+    archivia(conn, 6)
+    righe, _, altre = leggi_pagina(conn, None, "succ", 20)
+    assert altre and all(r["segnalazione"].startswith("nuova") for r in righe)
+    assert archivi_agganciati(conn) == []
+    conn.close()
+
+
+@pytest.mark.parametrize("decrescente", [False, True])
+def test_righe_partizioni_in_ordine(archiviato, decrescente):
+    conn, attese, _ = archiviato
+    trovate = [(riga[3], riga[0]) for riga in righe_partizioni(conn, decrescente=decrescente)]
+    assert trovate == (attese if decrescente else attese[::-1])
+    # Un periodo a cavallo di tre archivi
+    inizio, fine = attese[-1][0] + 2 * 365 * 86400, attese[-1][0] + 4 * 365 * 86400
+    trovate = [(riga[3], riga[0]) for riga in righe_partizioni(conn, inizio, fine, decrescente=True)]
+    assert trovate == [a for a in attese if inizio <= a[0] < fine]
+
+
+def test_letture_complete_su_tutti_gli_archivi(archiviato):
+    conn, attese, _ = archiviato
+    assert sum(giorno[1] for giorno in pianifica_giorni(conn, None, None, None)) == len(attese)
+    assert esporta(conn, io.StringIO(), "jsonl") == len(attese)
+    assert pianifica_giorni(conn, date(1990, 1, 1), date(1990, 1, 2), None) == []
+
+
+def test_ricostruzione_statistiche(archiviato):
+    conn, attese, _ = archiviato
+    ricostruisci_statistiche(conn)
+    while True:
+        with conn:
+            if not conta_arretrati_statistiche(conn, 5000):
+                break
+    assert conn.execute("SELECT SUM(conteggio) FROM statistiche_mesi").fetchone()[0] == len(attese)
+
+
+def test_archivio_in_uso_non_viene_sganciato(archiviato):
+    conn, _, _ = archiviato
+    schemi = [riga[0] for riga in conn.execute("SELECT schema FROM archivi ORDER BY inizio")]
+    # Una query aperta sul primo archivio mentre se ne agganciano altri
+    aperta = righe_partizioni(conn, decrescente=False)
+    next(aperta)
+    for riga in righe_partizioni(conn, decrescente=True):
+        pass
+    assert schemi[0] in archivi_agganciati(conn)
+    assert len(archivi_agganciati(conn)) <= MASSIMO_ARCHIVI_AGGANCIATI
+    aperta.close()
+
+
+def test_ricerca_negli_archivi(archiviato):
+    conn, attese, _ = archiviato
+    idranti = {r[0] for r in righe_partizioni(conn) if r[2].endswith("idrante")}
+    assert len(idranti) == len(attese) // 20 + 1
+    espressione = espressione_fts(["idrante"])
+    soglie, finestra, cursore, trovati = [None], 0, None, []
+    while True:
+        righe, _, meno_pertinenti, finestra, soglie, _ = bot.leggi_ricerca(
+            conn, espressione, None, None, None, soglie, finestra, cursore, "succ"
+        )
+        trovati += [r["id"] for r in righe]
+        if not (meno_pertinenti or len(soglie) > finestra + 1):
+            break
+        cursore = (righe[-1]["punteggio"], righe[-1]["id"])
+    assert len(trovati) == len(set(trovati)) and set(trovati) == idranti
+    assert len(archivi_agganciati(conn)) <= MASSIMO_ARCHIVI_AGGANCIATI
+
+    # Con un periodo si cercano solo gli archivi che lo coprono
+    inizio, fine = attese[-1][0] + 3 * 365 * 86400, attese[-1][0] + 3 * 365 * 86400 + 30 * 86400
+    righe, _, _, _ = cerca_segnalazioni(conn, espressione, inizio=inizio, fine=fine, limite=1000)
+    assert {r["id"] for r in righe} == {
+        r[0] for r in righe_partizioni(conn, inizio, fine) if r[2].endswith("idrante")
+    }
+
+
+def test_archivi_senza_indice_e_archiviazione_ripetuta(tmp_path):
+    conn = apri_connessione(str(tmp_path / "segnalazioni.db"))
+    migra(conn)
+    vecchia = int(time.time()) - 800 * 86400
+    importa_righe(conn, [("A", f"pozzetto {i}", vecchia + i * 60) for i in range(100)])
+    giorno = bot.da_epoch(vecchia)
+    archivia_mese(conn, giorno.year, giorno.month)
+    # Come un archivio creato prima degli indici negli archivi
+    schema = aggancia(conn, f"archivio_{giorno.year}", f"segnalazioni_archivio_{giorno.year}.db")
+    conn.execute(f"DROP TABLE {schema}.segnalazioni_fts")
+    conn.execute(f"DETACH DATABASE {schema}")
+    aggiorna_archivi(conn)
+    righe, _, _, _ = cerca_segnalazioni(conn, espressione_fts(["pozzetto"]), limite=1000)
+    assert len(righe) == 100
+
+    # Un'archiviazione interrotta dopo la copia si ripete senza doppioni nell'indice
+    importa_righe(conn, [("B", f"pozzetto bis {i}", vecchia + 3600 + i) for i in range(10)])
+    schema = aggancia(conn, f"archivio_{giorno.year}", f"segnalazioni_archivio_{giorno.year}.db")
+    with conn:
+        conn.execute(
+            f"INSERT INTO {schema}.segnalazioni_fts (rowid, segnalazione) "
+            "SELECT id, segnalazione FROM main.segnalazioni WHERE segnalazione LIKE 'pozzetto bis%'"
+        )
+        conn.execute(
+            f"INSERT INTO {schema}.segnalazioni SELECT * FROM main.segnalazioni "
+            "WHERE segnalazione LIKE 'pozzetto bis%'"
+        )
+    conn.execute(f"DETACH DATABASE {schema}")
+    archivia_mese(conn, giorno.year, giorno.month)
+    righe, _, _, _ = cerca_segnalazioni(conn, espressione_fts(["pozzetto"]), limite=1000)
+    assert len(righe) == 110
+    schema = aggancia(conn, f"archivio_{giorno.year}", f"segnalazioni_archivio_{giorno.year}.db")
+    with conn:
+        # Con rank 1 l'indice si confronta anche con il contenuto
+        conn.execute(
+            f"INSERT INTO {schema}.segnalazioni_fts (segnalazioni_fts, rank) VALUES ('integrity-check', 1)"
+        )
+    conn.execute(f"DETACH DATABASE {schema}")
+    conn.close()
@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+from database import Database, apri_connessione, conta_segnalazioni, migra
+
+CAMPI = ("id", "turno", "segnalazione", "data")
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Un Database su un file temporaneo al posto di bot.db, con la cache di /lista vuota."""
+    path = str(tmp_path / "segnalazioni.db")
+    conn = apri_connessione(path)
+    migra(conn)
+    conn.close()
+    nuovo = Database(path)
+    nuovo.osserva_inserimenti(bot.aggiorna_cache_liste)
+    monkeypatch.setattr(bot, "db", nuovo)
+    bot.cache_liste.svuota()
+    yield nuovo
+    bot.cache_liste.svuota()
+
+
+def esegui(database, scenario):
+    async def principale():
+        await database.avvia()
+        try:
+            await scenario()
+        finally:
+            await database.chiudi()
+    asyncio.run(principale())
+
+
+def campi(righe):
+    return [tuple(riga[c] for c in CAMPI) for riga in righe]
+
+
+def pulsanti(tastiera):
+    return [] if tastiera is None else [p.callback_data for riga in tastiera.inline_keyboard for p in riga]
+
+
+async def sfoglia():
+    """Scorre /lista fino in fondo e torna indietro, come l'utente: riempie la cache."""
+    (righe, _, piu_vecchie, _, _), _ = await bot.pagina_lista(None, "succ")
+    pagine = [righe]
+    while piu_vecchie:
+        (righe, _, piu_vecchie, _, _), _ = await bot.pagina_lista((righe[-1]["data"], righe[-1]["id"]), "succ")
+        pagine.append(righe)
+    for righe in pagine[1:]:
+        await bot.pagina_lista((righe[0]["data"], righe[0]["id"]), "prec")
+    return len(pagine)
+
+
+def confronta_cache(path):
+    """Ogni pagina in cache deve essere quella che si leggerebbe dal database."""
+    conn = apri_connessione(path)
+    try:
+        assert bot.cache_liste.leggi("totale") == conta_segnalazioni(conn)
+        confrontate = 0
+        for chiave, pagina in bot.cache_liste.voci():
+            if chiave == "totale":
+                continue
+            righe, piu_recenti, piu_vecchie, corpo, tastiera = pagina
+            attese, recenti_attese, vecchie_attese, _ = bot.leggi_pagina_lista(conn, *chiave)
+            assert campi(righe) == campi(attese), chiave
+            assert (piu_recenti, piu_vecchie) == (recenti_attese, vecchie_attese), chiave
+            if attese:
+                corpo_atteso, tastiera_attesa = bot.componi_pagina_lista(attese, recenti_attese, vecchie_attese)
+                assert corpo == corpo_atteso and pulsanti(tastiera) == pulsanti(tastiera_attesa), chiave
+            confrontate += 1
+        return confrontate
+    finally:
+        conn.close()
+
+
+def test_pagine_in_cache_dopo_le_insert(database):
+    adesso = int(time.time())
+
+    async def scenario():
+        await asyncio.gather(*(
+            database.inserisci_segnalazione("ABCD"[i % 4], f"riga {i}", adesso - 3600 - i * 60)
+            for i in range(45)
+        ))
+        assert await sfoglia() == 3
+        assert confronta_cache(database.path) == 5
+
+        # Una segnalazione nuova: la prima pagina si aggiorna senza rileggere
+        await database.inserisci_segnalazione("A", "nuova", adesso)
+        assert bot.cache_liste.leggi((None, "succ"))[0][0]["segnalazione"] == "nuova"
+        confronta_cache(database.path)
+
+        # Un gruppo committato insieme, in ordine sparso
+        await asyncio.gather(*(
+            database.inserisci_segnalazione("B", f"gruppo {i}", adesso + 10 - i * 3) for i in range(3)
+        ))
+        confronta_cache(database.path)
+
+        # Una segnalazione con una data vecchia, in mezzo alla seconda pagina
+        await database.inserisci_segnalazione("C", "in ritardo", adesso - 3600 - 30 * 60 - 30)
+        confronta_cache(database.path)
+        assert await sfoglia() == 3
+        confronta_cache(database.path)
+
+        # Più righe nuove di una pagina intera
+        await asyncio.gather(*(
+            database.inserisci_segnalazione("D", f"raffica {i}", adesso + 100 + i)
+            for i in range(bot.SEGNALAZIONI_PER_PAGINA + 5)
+        ))
+        assert (None, "succ") in dict(bot.cache_liste.voci())
+        confronta_cache(database.path)
+        assert await sfoglia() == 4
+        confronta_cache(database.path)
+
+    esegui(database, scenario)
+
+
+def test_prima_pagina_vuota_in_cache(database):
+    async def scenario():
+        (righe, _, _, corpo, _), totale = await bot.pagina_lista(None, "succ")
+        assert righe == [] and corpo is None and totale == 0
+        await database.inserisci_segnalazione("A", "prima", int(time.time()))
+        assert confronta_cache(database.path) == 1
+        (righe, _, piu_vecchie, _, _), totale = await bot.pagina_lista(None, "succ")
+        assert campi(righe)[0][2] == "prima" and not piu_vecchie and totale == 1
+        # La prima pagina in cache si riempie e compare il pulsante per le più vecchie
+        await asyncio.gather(*(
+            database.inserisci_segnalazione("B", f"dopo {i}", int(time.time()) + 1 + i)
+            for i in range(bot.SEGNALAZIONI_PER_PAGINA)
+        ))
+        assert confronta_cache(database.path) == 1
+        assert bot.cache_liste.leggi((None, "succ"))[2]
+
+    esegui(database, scenario)
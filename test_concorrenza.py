@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+from database import (
+    apri_connessione, conta_arretrati_statistiche, importa_righe, indicizza_arretrati, migra,
+    ricostruisci_statistiche,
+)
+from trasferimento import completa_indice, completa_statistiche
+
+RIGHE = 3000
+
+
+@pytest.fixture
+def connessioni(tmp_path):
+    """Due connessioni allo stesso database, come il bot e la riga di comando."""
+    path = str(tmp_path / "segnalazioni.db")
+    prima = apri_connessione(path)
+    migra(prima)
+    seconda = apri_connessione(path)
+    yield prima, seconda
+    prima.close()
+    seconda.close()
+
+
+def righe(da, quante, testo="cisterna"):
+    return [("ABCD"[i % 4], f"{testo} {da + i}", 1700000000 + (da + i) * 60) for i in range(quante)]
+
+
+def intromissione(conn, inizio_istruzione, funzione, attesa=0.5):
+    """
+    Quando conn inizia un'istruzione che comincia così, esegue funzione
+    una volta in un altro thread, e aspetta che finisca o che resti
+    bloccata in attesa del lock di scrittura.
+    """
+    thread = threading.Thread(target=funzione)
+
+    def traccia(istruzione):
+        if thread.ident is None and istruzione.startswith(inizio_istruzione):
+            thread.start()
+            thread.join(attesa)
+
+    conn.set_trace_callback(traccia)
+    return thread
+
+
+def test_indice_completato_durante_un_importazione(connessioni):
+    bot, riga_di_comando = connessioni
+    importa_righe(riga_di_comando, righe(0, RIGHE))
+    # Il bot legge l'intervallo da indicizzare, intanto arriva un altro lotto
+    thread = intromissione(
+        bot, "SELECT id FROM segnalazioni WHERE id >=",
+        lambda: importa_righe(riga_di_comando, righe(RIGHE, RIGHE)),
+    )
+    with bot:
+        assert indicizza_arretrati(bot, 1000) == 1000
+    thread.join()
+    bot.set_trace_callback(None)
+    assert thread.ident is not None
+
+    completa_indice(bot)
+    assert bot.execute(
+        "SELECT COUNT(*) FROM segnalazioni_fts WHERE segnalazioni_fts MATCH 'cisterna'"
+    ).fetchone()[0] == 2 * RIGHE
+    with bot:
+        bot.execute("INSERT INTO segnalazioni_fts (segnalazioni_fts, rank) VALUES ('integrity-check', 1)")
+
+
+# Con un blocco che copre tutto il segnaposto si cancella invece di spostarsi
+@pytest.mark.parametrize("blocco", [1000, 2 * RIGHE])
+def test_statistiche_ricostruite_da_due_processi(connessioni, blocco):
+    bot, riga_di_comando = connessioni
+    importa_righe(riga_di_comando, righe(0, RIGHE))
+    ricostruisci_statistiche(riga_di_comando)
+    # Il bot legge il blocco da contare, intanto la riga di comando conta lo stesso
+    thread = intromissione(
+        bot, "SELECT id, turno, data FROM main.segnalazioni",
+        lambda: completa_statistiche(riga_di_comando, blocco),
+    )
+    with bot:
+        conta_arretrati_statistiche(bot, blocco)
+    thread.join()
+    bot.set_trace_callback(None)
+    assert thread.ident is not None
+
+    completa_statistiche(bot, blocco)
+    for tabella in ("statistiche_mesi", "statistiche_fasce"):
+        assert bot.execute(f"SELECT SUM(conteggio) FROM {tabella}").fetchone()[0] == RIGHE
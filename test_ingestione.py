@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from database import Database, apri_connessione, migra
+
+
+class Messaggio:
+    """Il minimo di telegram.Message che serve a salva_segnalazioni."""
+
+    def __init__(self, text):
+        self.text = text
+        self.risposte = []
+
+    async def reply_text(self, testo, **kwargs):
+        self.risposte.append(testo)
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    path = str(tmp_path / "segnalazioni.db")
+    conn = apri_connessione(path)
+    migra(conn)
+    conn.close()
+    nuovo = Database(path)
+    monkeypatch.setattr(bot, "db", nuovo)
+    return nuovo
+
+
+def salvate(path):
+    conn = apri_connessione(path)
+    try:
+        return [r[0] for r in conn.execute("SELECT segnalazione FROM segnalazioni ORDER BY id")]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("estraneo", [None, Messaggio(None)])
+def test_raffica_con_un_elemento_senza_testo(database, estraneo):
+    m3, m4 = Messaggio("m3"), Messaggio("m4")
+
+    async def scenario():
+        await database.avvia()
+        try:
+            await bot.salva_segnalazioni([(m3, 1700000000.2), (estraneo, 1700000000.5), (m4, 1700000001.7)])
+        finally:
+            await database.chiudi()
+
+    asyncio.run(scenario())
+    assert salvate(database.path) == ["m3", "m4"]
+    assert m3.risposte == [] and len(m4.risposte) == 1 and m4.risposte[0].startswith("✅ 2 segnalazioni")
+
+
+def test_messaggio_modificato_non_accodato(monkeypatch):
+    accodati = []
+
+    async def accoda(chat_id, messaggio):
+        accodati.append(messaggio)
+
+    monkeypatch.setattr(bot.ingestione, "accoda", accoda)
+    modifica = SimpleNamespace(message=None, effective_chat=SimpleNamespace(id=1))
+    nuovo = SimpleNamespace(message=Messaggio("m5"), effective_chat=SimpleNamespace(id=1))
+    asyncio.run(bot.gestisci_messaggio(modifica, None))
+    asyncio.run(bot.gestisci_messaggio(nuovo, None))
+    assert accodati == [nuovo.message]
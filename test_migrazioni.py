@@ -0,0 +1,74 @@
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from database import MIGRAZIONI, apri_connessione, conta_segnalazioni, migra
+
+ROMA = ZoneInfo("Europe/Rome")
+ORIGINALE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "segnalazioni.db")
+
+# Date nel formato testo dello schema originale, in ora italiana
+DATE = [
+    "2024-01-15 12:00:00",
+    "2024-03-31 01:59:59",  # ultimo secondo di ora solare
+    "2024-03-31 02:30:00",  # ora saltata: diventa le 03:30 legali
+    "2024-03-31 03:00:00",
+    "2024-10-27 01:59:59",
+    "2024-10-27 02:30:00",  # ora ripetuta: vale la prima, legale
+    "2024-10-27 03:00:00",
+    "2024-12-31 23:59:59",
+    "2025-07-01 08:00:00",
+    None,
+]
+
+
+def epoch_atteso(testo):
+    if testo is None:
+        return 0
+    return int(datetime.strptime(testo, "%Y-%m-%d %H:%M:%S").replace(tzinfo=ROMA).timestamp())
+
+
+def test_migra_db_originale(tmp_path):
+    path = str(tmp_path / "segnalazioni.db")
+    shutil.copy(ORIGINALE, path)
+    with sqlite3.connect(path) as vecchio:
+        assert vecchio.execute("PRAGMA user_version").fetchone()[0] == 0
+        vecchio.executemany(
+            "INSERT INTO segnalazioni (turno, segnalazione, data) VALUES (?, ?, ?)",
+            [("ABCD"[i % 4], f"riga {i}", data) for i, data in enumerate(DATE)] + [(None, None, None)],
+        )
+        # Un buco negli id, come dopo una cancellazione
+        vecchio.execute("DELETE FROM segnalazioni WHERE segnalazione = 'riga 3'")
+        originali = vecchio.execute("SELECT id, turno, segnalazione, data FROM segnalazioni ORDER BY id").fetchall()
+        ultimo_id = vecchio.execute("SELECT seq FROM sqlite_sequence WHERE name = 'segnalazioni'").fetchone()[0]
+    vecchio.close()
+
+    conn = apri_connessione(path)
+    assert migra(conn) == len(MIGRAZIONI)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRAZIONI)
+    migrate = conn.execute("SELECT id, turno, segnalazione, data FROM segnalazioni ORDER BY id").fetchall()
+    assert [tuple(r) for r in migrate] == [
+        (id_riga, turno or "", segnalazione or "", epoch_atteso(data))
+        for id_riga, turno, segnalazione, data in originali
+    ]
+    assert [r[0] for r in conn.execute("SELECT DISTINCT typeof(data) FROM segnalazioni")] == ["integer"]
+
+    # Il contatore parte dal numero di righe e segue insert e delete
+    conteggio = conn.execute("SELECT COUNT(*) FROM segnalazioni").fetchone()[0]
+    assert conteggio == len(originali)
+    assert conta_segnalazioni(conn) == conteggio
+    with conn:
+        cursore = conn.execute(
+            "INSERT INTO segnalazioni (turno, segnalazione, data) VALUES ('A', 'nuova', ?)",
+            (epoch_atteso(DATE[-2]),),
+        )
+        assert cursore.lastrowid == ultimo_id + 1
+        conn.execute("DELETE FROM segnalazioni WHERE id = 1")
+    assert conta_segnalazioni(conn) == conteggio
+
+    # Una seconda migrazione non cambia nulla
+    assert migra(conn) == len(MIGRAZIONI)
+    assert conta_segnalazioni(conn) == conteggio
+    conn.close()
@@ -0,0 +1,107 @@
+import pytest
+
+import bot
+from database import CANDIDATI_RICERCA, apri_connessione, cerca_segnalazioni, espressione_fts, migra
+
+CORRISPONDENZE = 801
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = apri_connessione(str(tmp_path / "segnalazioni.db"))
+    migra(conn)
+    with conn:
+        conn.executemany(
+            "INSERT INTO segnalazioni (turno, segnalazione, data) VALUES (?, ?, ?)",
+            [
+                ("ABCD"[i % 4], f"guasto pompa {'pompa ' * (i % 7)}reparto {i}" if i % 3 else f"controllo {i}",
+                 1700000000 + i * 60)
+                for i in range(CORRISPONDENZE * 3 // 2 + 1)
+            ],
+        )
+    yield conn
+    conn.close()
+
+
+def corrispondenze(conn):
+    return {r[0] for r in conn.execute("SELECT id FROM segnalazioni WHERE segnalazione LIKE 'guasto%'")}
+
+
+def scorri(conn, espressione, prima_pagina=None):
+    """Segue i pulsanti "avanti" come farebbe l'utente: [(finestra, righe)] e le soglie finali."""
+    soglie, finestra, cursore, pagine = [None], 0, None, []
+    while True:
+        righe, _, meno_pertinenti, finestra, soglie, _ = bot.leggi_ricerca(
+            conn, espressione, None, None, None, soglie, finestra, cursore, "succ"
+        )
+        pagine.append((finestra, righe))
+        if prima_pagina:
+            prima_pagina()
+            prima_pagina = None
+        if not (meno_pertinenti or len(soglie) > finestra + 1):
+            return pagine, soglie
+        cursore = (righe[-1]["punteggio"], righe[-1]["id"])
+
+
+def test_tutte_le_corrispondenze_raggiungibili(conn):
+    assert len(corrispondenze(conn)) == CORRISPONDENZE
+    pagine, soglie = scorri(conn, espressione_fts(["guasto"]))
+    ids = [r["id"] for _, righe in pagine for r in righe]
+    assert len(ids) == len(set(ids)) and set(ids) == corrispondenze(conn)
+    assert len(soglie) == -(-CORRISPONDENZE // CANDIDATI_RICERCA)
+    # Dentro una finestra l'ordine è per pertinenza
+    for finestra in range(len(soglie)):
+        punteggi = [r["punteggio"] for f, righe in pagine if f == finestra for r in righe]
+        assert punteggi == sorted(punteggi)
+
+
+def test_all_indietro_si_ritrovano_le_stesse_pagine(conn):
+    espressione = espressione_fts(["guasto"])
+    pagine, soglie = scorri(conn, espressione)
+    finestra, righe = pagine[-1]
+    for finestra_attesa, attese in reversed(pagine[:-1]):
+        righe, _, _, finestra, soglie, _ = bot.leggi_ricerca(
+            conn, espressione, None, None, None, soglie, finestra,
+            (righe[0]["punteggio"], righe[0]["id"]), "prec"
+        )
+        assert finestra == finestra_attesa
+        assert [r["id"] for r in righe] == [r["id"] for r in attese]
+
+
+def test_segnalazioni_nuove_non_spostano_le_finestre(conn):
+    attese = corrispondenze(conn)
+
+    def inserisci():
+        with conn:
+            conn.executemany(
+                "INSERT INTO segnalazioni (turno, segnalazione, data) VALUES ('A', ?, ?)",
+                [(f"guasto nuovo {i}", 1800000000 + i) for i in range(300)],
+            )
+
+    pagine, _ = scorri(conn, espressione_fts(["guasto"]), prima_pagina=inserisci)
+    assert {r["id"] for _, righe in pagine for r in righe} == attese
+
+
+def test_una_sola_finestra_senza_avviso(conn):
+    espressione = espressione_fts(["reparto", "1"])
+    righe, _, _, successiva = cerca_segnalazioni(conn, espressione)
+    assert righe and successiva is None
+    ricerca = {'termini': ["reparto", "1"], 'dal': None, 'al': None, 'turno': None, 'soglie': [1]}
+    risposta, _ = bot.componi_pagina_ricerca(1, ricerca, righe, False, True, 0, False)
+    assert "gruppi" not in risposta
+
+
+def test_intestazione_avvisa_dei_gruppi_ed_e_escapata(conn):
+    ricerca = {'termini': ["guasto_pompa"], 'dal': None, 'al': None, 'turno': None, 'soglie': [None]}
+    righe, piu, meno, finestra, ricerca['soglie'], _ = bot.leggi_ricerca(
+        conn, espressione_fts(["guasto"]), None, None, None, ricerca['soglie'], 0, None, "succ"
+    )
+    risposta, tastiera = bot.componi_pagina_ricerca(1, ricerca, righe, piu, meno, finestra, False)
+    assert f"gruppi di {CANDIDATI_RICERCA}" in risposta and "gruppo 1_" in risposta
+    assert "guasto\\_pompa" in risposta
+    assert all(len(p.callback_data.encode()) <= 64 for riga in tastiera.inline_keyboard for p in riga)
+
+
+@pytest.mark.parametrize("termini", [['"'], ['""', '"'], []])
+def test_espressione_vuota(termini):
+    assert espressione_fts(termini) == ""
@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from orario import a_epoch, da_epoch, offset_epoch, prossimo_cambio_ora, transizioni
+from turni import calendario, turno_attuale
+
+ROMA = ZoneInfo("Europe/Rome")
+ANNI = range(2020, 2031)
+
+
+def offset_atteso(epoch):
+    return datetime.fromtimestamp(epoch, ROMA).utcoffset().total_seconds() / 3600
+
+
+@pytest.mark.parametrize("anno", ANNI)
+def test_offset_attorno_ai_cambi(anno):
+    for cambio in transizioni(anno):
+        assert datetime.fromtimestamp(cambio, timezone.utc).hour == 1
+        for delta in (-3601, -3600, -1, 0, 1, 3599, 3600):
+            epoch = cambio + delta
+            atteso = offset_atteso(epoch)
+            assert offset_epoch(epoch) == atteso
+            assert da_epoch(epoch).utcoffset().total_seconds() / 3600 == atteso
+            # Stessa ora sul quadrante (nell'ora ripetuta datetime con fusi diversi non sono mai uguali)
+            assert da_epoch(epoch).replace(tzinfo=None) == datetime.fromtimestamp(epoch, ROMA).replace(tzinfo=None)
+        assert prossimo_cambio_ora(cambio - 1) == cambio
+        assert prossimo_cambio_ora(cambio) > cambio
+
+
+@pytest.mark.parametrize("anno", ANNI)
+def test_offset_ora_per_ora(anno):
+    inizio = int(datetime(anno, 1, 1, tzinfo=timezone.utc).timestamp())
+    fine = int(datetime(anno + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+    for epoch in range(inizio, fine, 3600):
+        assert offset_epoch(epoch) == offset_atteso(epoch)
+
+
+@pytest.mark.parametrize("anno", ANNI)
+def test_a_epoch_attorno_ai_cambi(anno):
+    marzo, ottobre = (datetime.fromtimestamp(c, ROMA) for c in transizioni(anno))
+    # Ore locali normali prima e dopo i cambi
+    for giorno in (marzo, ottobre):
+        for ore in (-26, -3, 3, 26):
+            locale = (giorno + timedelta(hours=ore)).replace(tzinfo=None)
+            assert a_epoch(locale) == int(locale.replace(tzinfo=ROMA).timestamp())
+    # Nell'ora saltata di marzo si scivola in avanti di un'ora
+    saltata = datetime(anno, 3, marzo.day, 2, 30)
+    assert a_epoch(saltata) == int(datetime(anno, 3, marzo.day, 3, 30, tzinfo=ROMA).timestamp())
+    # Nell'ora ripetuta di ottobre vale l'ora legale (la prima delle due)
+    ripetuta = datetime(anno, 10, ottobre.day, 2, 30)
+    assert a_epoch(ripetuta) == int(ripetuta.replace(tzinfo=ROMA, fold=0).timestamp())
+    assert da_epoch(a_epoch(ripetuta)).utcoffset() == timedelta(hours=2)
+
+
+@pytest.mark.parametrize("anno", ANNI)
+def test_finestre_alle_otto_e_alle_venti(anno):
+    inizio = int(datetime(anno, 1, 1, tzinfo=timezone.utc).timestamp())
+    fine = int(datetime(anno + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+    finestre = calendario.finestre_tra(inizio, fine)
+    assert finestre[0].inizio <= inizio and finestre[-1].fine >= fine
+    for precedente, finestra in zip(finestre, finestre[1:]):
+        assert precedente.fine == finestra.inizio
+        assert precedente.notturno != finestra.notturno
+        locale = datetime.fromtimestamp(finestra.inizio, ROMA)
+        assert (locale.hour, locale.minute, locale.second) == ((20, 0, 0) if finestra.notturno else (8, 0, 0))
+        # Chi fa il diurno fa il notturno del giorno dopo
+        if not precedente.notturno:
+            successivo = calendario.finestra(precedente.fine + 25 * 3600)
+            assert successivo.notturno and successivo.turno == precedente.turno
+    for finestra in finestre:
+        # Un secondo prima e al cambio turno
+        assert calendario.finestra(finestra.inizio) == finestra
+        assert calendario.finestra(finestra.fine - 1) == finestra
+        assert turno_attuale(finestra.inizio)[0] == finestra.turno
+
+
+@pytest.mark.parametrize("anno", ANNI)
+def test_notti_del_cambio_ora(anno):
+    marzo, ottobre = transizioni(anno)
+    corta, lunga = calendario.finestra(marzo), calendario.finestra(ottobre)
+    assert corta.notturno and corta.fine - corta.inizio == 11 * 3600
+    assert lunga.notturno and lunga.fine - lunga.inizio == 13 * 3600
+    # Tutte le altre durano 12 ore
+    inizio = int(datetime(anno, 1, 1, tzinfo=timezone.utc).timestamp())
+    fine = int(datetime(anno + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+    durate = [f.fine - f.inizio for f in calendario.finestre_tra(inizio, fine) if f not in (corta, lunga)]
+    assert set(durate) == {12 * 3600}
+    # Il turno resta lo stesso per tutta la notte, anche nell'ora ripetuta
+    for epoch in range(lunga.inizio, lunga.fine, 600):
+        assert turno_attuale(epoch) == (lunga.turno, offset_atteso(epoch))
+
+
+def test_rotazione_di_riferimento():
+    # Il 18/10/2024 il diurno è della squadra B e il notturno della A
+    assert turno_attuale(a_epoch(datetime(2024, 10, 18, 8)))[0] == "B"
+    assert turno_attuale(a_epoch(datetime(2024, 10, 18, 19, 59, 59)))[0] == "B"
+    assert turno_attuale(a_epoch(datetime(2024, 10, 18, 20)))[0] == "A"
+    assert turno_attuale(a_epoch(datetime(2024, 10, 19, 8)))[0] == "C"
+    assert turno_attuale(a_epoch(datetime(2024, 10, 19, 20)))[0] == "B"
+
+
+@pytest.mark.parametrize("giorno", [
+    datetime(2024, 10, 19), datetime(2024, 10, 27), datetime(2025, 1, 1),
+    datetime(2025, 3, 30), datetime(2025, 10, 26), datetime(2026, 7, 15),
+])
+def test_notte_dopo_mezzanotte_al_turno_della_sera_prima(giorno):
+    # Dalle 00:00 alle 08:00 lavora ancora chi ha iniziato alle 20:00 del giorno prima
+    sera = turno_attuale(a_epoch(giorno - timedelta(hours=4)))[0]
+    for ora in (0, 1, 4, 7):
+        assert turno_attuale(a_epoch(giorno.replace(hour=ora)))[0] == sera
+    assert turno_attuale(a_epoch(giorno.replace(hour=7, minute=59, second=59)))[0] == sera
+    assert turno_attuale(a_epoch(giorno.replace(hour=8)))[0] != sera
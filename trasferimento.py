@@ -0,0 +1,150 @@
+import csv
+import itertools
+import json
+from datetime import datetime
+
+from database import conta_arretrati_statistiche, importa_righe, indicizza_arretrati, righe_partizioni
+from orario import a_epoch, da_epoch
+from turni import TURNI, turno_attuale
+
+# Righe per transazione nelle importazioni e per blocco nelle esportazioni
+RIGHE_PER_LOTTO = 50000
+
+CACHE_IMPORTAZIONE_KB = 64 * 1024
+
+TURNI_VALIDI = frozenset(TURNI)
+
+COLONNE = ["id", "turno", "segnalazione", "data", "ora_italia"]
+
+
+def formato_da_file(nome):
+    return "jsonl" if nome.endswith((".jsonl", ".json")) else "csv"
+
+
+def _leggi_data(valore):
+    """Epoch intero, oppure data ISO: con offset, o senza se in ora italiana."""
+    if isinstance(valore, (int, float)):
+        return int(valore)
+    istante = datetime.fromisoformat(valore)
+    if istante.tzinfo is None:
+        return a_epoch(istante)
+    return int(istante.timestamp())
+
+
+def _record(sorgente, formato):
+    if formato == "csv":
+        lettore = csv.reader(sorgente)
+        intestazione = next(lettore, [])
+        try:
+            colonne = [intestazione.index(nome) for nome in ("segnalazione", "data")]
+        except ValueError:
+            raise ValueError("Il CSV deve avere almeno le colonne segnalazione e data")
+        colonna_turno = intestazione.index("turno") if "turno" in intestazione else None
+        testo, data = colonne
+        larghezza = max(colonne + [colonna_turno or 0]) + 1
+        for riga in lettore:
+            if len(riga) < larghezza:
+                if not riga:
+                    continue
+                raise ValueError(f"Riga CSV incompleta: {riga!r}")
+            yield (riga[colonna_turno] if colonna_turno is not None else None), riga[testo], riga[data]
+    else:
+        # Una sola chiamata a json.loads per migliaia di righe costa molto
+        # meno di una per riga; in caso di errore si ripete riga per riga
+        # per indicare quella sbagliata
+        while linee := [linea for linea in itertools.islice(sorgente, 10000) if linea.strip()]:
+            try:
+                oggetti = json.loads("[" + ",".join(linee) + "]")
+            except ValueError:
+                oggetti = None
+            # Una riga come 1,2 darebbe due valori: le righe non tornerebbero più
+            if oggetti is None or len(oggetti) != len(linee):
+                oggetti = []
+                for linea in linee:
+                    try:
+                        oggetti.append(json.loads(linea))
+                    except ValueError:
+                        raise ValueError(f"Riga JSON non valida: {linea.strip()[:80]!r}")
+            for linea, oggetto in zip(linee, oggetti):
+                if not isinstance(oggetto, dict):
+                    raise ValueError(f"Riga JSON non valida: {linea.strip()[:80]!r}")
+                yield oggetto.get("turno"), oggetto.get("segnalazione"), oggetto.get("data")
+
+
+def _righe_importate(sorgente, formato):
+    for numero, (turno, segnalazione, data) in enumerate(_record(sorgente, formato), start=1):
+        try:
+            # Di solito è già un epoch, come nelle esportazioni
+            epoch = int(data)
+        except (TypeError, ValueError):
+            try:
+                epoch = _leggi_data(data)
+            except (TypeError, ValueError):
+                raise ValueError(f"Riga {numero}: data non valida {data!r}")
+        # Il vecchio registro non sempre ha il turno: si ricava dal calendario
+        if not turno:
+            turno = turno_attuale(epoch)[0]
+        elif turno not in TURNI_VALIDI:
+            raise ValueError(f"Riga {numero}: turno non valido {turno!r}")
+        yield turno, segnalazione or "", epoch
+
+
+def importa(conn, sorgente, formato, lotto=RIGHE_PER_LOTTO):
+    """
+    Importa un file CSV o JSONL (colonne turno, segnalazione, data) a
+    lotti, uno per transazione. Restituisce il numero di righe importate.
+    """
+    righe = _righe_importate(sorgente, formato)
+    # Più cache per le pagine degli indici durante le insert massive
+    conn.execute(f"PRAGMA cache_size = -{CACHE_IMPORTAZIONE_KB}")
+    importate = 0
+    try:
+        while blocco := list(itertools.islice(righe, lotto)):
+            importa_righe(conn, blocco)
+            importate += len(blocco)
+    finally:
+        conn.execute("PRAGMA cache_size = -2000")
+    return importate
+
+
+def _a_blocchi(conn, funzione, blocco):
+    # Un blocco per transazione, finché la funzione ha lavoro da fare
+    totale = 0
+    while True:
+        with conn:
+            fatte = funzione(conn, blocco)
+        if not fatte:
+            return totale
+        totale += fatte
+
+
+def completa_indice(conn, blocco=RIGHE_PER_LOTTO):
+    """Indicizza nel full-text le righe importate, un blocco per transazione."""
+    return _a_blocchi(conn, indicizza_arretrati, blocco)
+
+
+def completa_statistiche(conn, blocco=RIGHE_PER_LOTTO):
+    """Riempie gli aggregati di /statistiche a blocchi di id, archivi compresi."""
+    return _a_blocchi(conn, conta_arretrati_statistiche, blocco)
+
+
+def esporta(conn, destinazione, formato, inizio=None, fine=None, turno=None, blocco=RIGHE_PER_LOTTO):
+    """
+    Scrive le segnalazioni di [inizio, fine), archivi compresi, dalla più
+    vecchia. Le righe vengono lette e scritte a blocchi.
+    """
+    righe = righe_partizioni(conn, inizio, fine, turno, blocco=blocco)
+    scrittore = csv.writer(destinazione) if formato == "csv" else None
+    if scrittore:
+        scrittore.writerow(COLONNE)
+    esportate = 0
+    while gruppo := list(itertools.islice(righe, blocco)):
+        valori = [(*riga, da_epoch(riga[3]).isoformat()) for riga in gruppo]
+        if scrittore:
+            scrittore.writerows(valori)
+        else:
+            destinazione.writelines(
+                json.dumps(dict(zip(COLONNE, riga)), ensure_ascii=False) + "\n" for riga in valori
+            )
+        esportate += len(gruppo)
+    return esportate
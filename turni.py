@@ -0,0 +1,106 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+
+from orario import a_epoch, offset_epoch
+
+# Rotazione a quattro squadre: ogni squadra fa un diurno (08-20), il
+# giorno dopo il notturno (20-08), poi due giorni di riposo.
+# Il 18/10/2024 il diurno è della squadra B e il notturno della A.
+TURNI = ['A', 'B', 'C', 'D']
+DATA_RIFERIMENTO = date(2024, 10, 18)
+ORA_INIZIO_DIURNO = 8
+ORA_INIZIO_NOTTURNO = 20
+
+
+class Finestra(NamedTuple):
+    turno: str
+    inizio: int  # epoch UTC, incluso
+    fine: int  # epoch UTC, escluso
+    notturno: bool
+
+
+def _finestre_anno(anno):
+    """Le finestre che iniziano nei giorni (ora italiana) dell'anno indicato."""
+    finestre = []
+    giorno = date(anno, 1, 1)
+    while giorno.year == anno:
+        giorni_passati = (giorno - DATA_RIFERIMENTO).days
+        mattina = datetime(giorno.year, giorno.month, giorno.day, ORA_INIZIO_DIURNO)
+        sera = mattina.replace(hour=ORA_INIZIO_NOTTURNO)
+        # I cambi turno sono in ora locale: la notte del cambio d'ora
+        # dura 11 o 13 ore, le altre 12
+        finestre.append(Finestra(
+            TURNI[(giorni_passati + 1) % len(TURNI)], a_epoch(mattina), a_epoch(sera), False
+        ))
+        finestre.append(Finestra(
+            TURNI[giorni_passati % len(TURNI)], a_epoch(sera),
+            a_epoch(mattina + timedelta(days=1)), True
+        ))
+        giorno += timedelta(days=1)
+    return finestre
+
+
+class CalendarioTurni:
+    """
+    Calendario dei turni precalcolato per anni interi.
+
+    Gli inizi delle finestre sono tenuti in una lista ordinata: trovare il
+    turno di un istante o le finestre di un intervallo è una ricerca binaria.
+    Gli anni mancanti vengono calcolati al primo uso.
+    """
+
+    def __init__(self):
+        self._inizi = []
+        self._finestre = []
+        self._anni = None
+        self._lock = threading.Lock()
+
+    def _copri(self, epoch):
+        # Un istante appartiene al più all'anno prima (notte di San Silvestro)
+        anno = time.gmtime(epoch).tm_year
+        with self._lock:
+            if self._anni is None:
+                self._anni = (anno - 1, anno)
+                self._finestre = _finestre_anno(anno - 1) + _finestre_anno(anno)
+            else:
+                primo, ultimo = self._anni
+                if primo <= anno - 1 and anno <= ultimo:
+                    return
+                prima = [f for a in range(min(primo, anno - 1), primo) for f in _finestre_anno(a)]
+                dopo = [f for a in range(ultimo + 1, max(ultimo, anno) + 1) for f in _finestre_anno(a)]
+                self._finestre = prima + self._finestre + dopo
+                self._anni = (min(primo, anno - 1), max(ultimo, anno))
+            self._inizi = [f.inizio for f in self._finestre]
+
+    def finestra(self, epoch):
+        """La finestra di turno che contiene l'istante."""
+        self._copri(epoch)
+        return self._finestre[bisect_right(self._inizi, epoch) - 1]
+
+    def finestre_tra(self, inizio, fine):
+        """Tutte le finestre che si sovrappongono all'intervallo [inizio, fine)."""
+        self._copri(inizio)
+        self._copri(fine + 1)
+        primo = bisect_right(self._inizi, inizio) - 1
+        ultimo = bisect_left(self._inizi, fine)
+        return self._finestre[primo:ultimo]
+
+    def prossime(self, epoch, quante):
+        """La finestra in corso e le successive, quante in tutto."""
+        self._copri(epoch)
+        indice = bisect_right(self._inizi, epoch) - 1
+        while indice + quante > len(self._finestre):
+            self._copri(self._finestre[-1].fine + 366 * 86400)
+        return self._finestre[indice:indice + quante]
+
+
+calendario = CalendarioTurni()
+
+
+def turno_attuale(epoch=None):
+    """Restituisce (lettera del turno, offset UTC in ore) all'istante indicato."""
+    epoch = time.time() if epoch is None else epoch
+    return calendario.finestra(epoch).turno, offset_epoch(epoch)
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import signal
+
+import tornado.web
+from telegram import Update
+
+from metriche import registro
+
+
+class _WebhookHandler(tornado.web.RequestHandler):
+    # self.application è già l'applicazione tornado
+    def initialize(self, telegram, secret_token):
+        self.telegram = telegram
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token and \
+                self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            raise tornado.web.HTTPError(403)
+        try:
+            dati = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        update = Update.de_json(dati, self.telegram.bot)
+        await self.telegram.update_queue.put(update)
+
+
+class _MetricheHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(registro.esporta())
+
+
+async def esegui_webhook(application, porta, webhook_url, secret_token=None,
+                         avvio=None, arresto=None):
+    """
+    Sostituisce application.run_webhook: riceve gli update sulla stessa
+    porta su cui espone le metriche Prometheus in /metrics.
+    """
+    server = tornado.web.Application([
+        (r"/metrics", _MetricheHandler),
+        (r"/", _WebhookHandler, {"telegram": application, "secret_token": secret_token}),
+    ]).listen(porta, address="0.0.0.0")
+    try:
+        async with application:
+            if avvio is not None:
+                await avvio(application)
+            await application.bot.set_webhook(
+                url=webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=secret_token
+            )
+            await application.start()
+            try:
+                # Resta in ascolto fino a SIGINT/SIGTERM, come run_webhook
+                fermo = asyncio.Event()
+                loop = asyncio.get_running_loop()
+                for segnale in (signal.SIGINT, signal.SIGTERM):
+                    loop.add_signal_handler(segnale, fermo.set)
+                await fermo.wait()
+            finally:
+                await application.stop()
+                # Come post_stop in run_polling: il bot può ancora rispondere
+                if arresto is not None:
+                    await arresto(application)
+    finally:
+        server.stop()